@@ -0,0 +1,144 @@
+"""
+benchmark 的 MR diff 语料，保存为 GitLab changes 接口格式的 JSON（benchmark/corpus/<name>.json）
+三档内置语料都已提交到仓库，benchmark 直接读取，不依赖本地 git 历史中的某个提交。
+重新录制时从本地 git 仓库的 --revision（默认 HEAD）的真实 diff 中生成：
+  small   该提交的 diff
+  medium  截至该提交的整个提交历史的 diff（root..revision）
+  large   5000 个文件，每个文件一个从该提交之前的历史提交中取出的真实 hunk（循环使用）
+也可以用 --record project!iid 从 GitLab 录制真实的 MR（需要 GITLAB_TOKEN / CI_API）
+
+用法：python benchmark/corpus.py [small medium large] [--repo PATH] [--revision REV] [--large-files 5000]
+     python benchmark/corpus.py --record 123!45 --name my_mr
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+from unidiff import PatchSet
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_NAMES = ("small", "medium", "large")
+
+
+def _strip_prefix(path):
+    return path[2:] if path.startswith(("a/", "b/")) else path
+
+
+def git_diff_changes(repo, base, head):
+    """
+    将 git diff base head 转换为 GitLab changes 列表，二进制文件跳过
+    """
+    diff = subprocess.run(
+        ["git", "-C", repo, "diff", "--no-color", "--no-ext-diff", "-U3", base, head],
+        capture_output=True, text=True, check=True
+    ).stdout
+    changes = []
+    for patched_file in PatchSet(diff.splitlines(keepends=True)):
+        if patched_file.is_binary_file or not len(patched_file):
+            continue
+        old_path = _strip_prefix(patched_file.source_file)
+        new_path = _strip_prefix(patched_file.target_file)
+        changes.append({
+            "old_path": new_path if old_path == "/dev/null" else old_path,
+            "new_path": old_path if new_path == "/dev/null" else new_path,
+            "new_file": patched_file.is_added_file,
+            "deleted_file": patched_file.is_removed_file,
+            "renamed_file": patched_file.is_rename,
+            "diff": "".join(str(hunk) for hunk in patched_file),
+        })
+    return changes
+
+
+def history_hunks(repo, revision, limit=200):
+    """
+    从 revision 及之前的 limit 个提交中取出修改已有文件的 hunk，返回 [(文件路径, hunk diff 文本)]
+    """
+    commits = subprocess.run(
+        ["git", "-C", repo, "rev-list", "--no-merges", f"--max-count={limit}", revision],
+        capture_output=True, text=True, check=True
+    ).stdout.split()
+    hunks = []
+    for commit in commits:
+        parents = subprocess.run(["git", "-C", repo, "rev-list", "--parents", "-n", "1", commit],
+                                 capture_output=True, text=True, check=True).stdout.split()
+        if len(parents) < 2:
+            continue
+        for change in git_diff_changes(repo, parents[1], commit):
+            if change["new_file"] or change["deleted_file"]:
+                continue
+            for hunk in PatchSet(f"--- a/{change['old_path']}\n+++ b/{change['new_path']}\n{change['diff']}"
+                                 .splitlines(keepends=True))[0]:
+                hunks.append((change["new_path"], str(hunk)))
+    return hunks
+
+
+def build_corpus(name, repo=REPO_ROOT, revision="HEAD", large_files=5000):
+    """ 从 git 仓库的 revision 录制一档内置语料（small / medium / large），返回 changes 列表 """
+    if name == "small":
+        return git_diff_changes(repo, f"{revision}~1", revision)
+    if name == "medium":
+        empty_tree = subprocess.run(["git", "-C", repo, "hash-object", "-t", "tree", os.devnull],
+                                    capture_output=True, text=True, check=True).stdout.strip()
+        return git_diff_changes(repo, empty_tree, revision)
+    hunks = history_hunks(repo, revision)
+    if not hunks:
+        raise RuntimeError(f"No modified-file hunks found in the history of {repo} at {revision}")
+    large = []
+    for i in range(large_files):
+        path, hunk = hunks[i % len(hunks)]
+        directory, file_name = os.path.split(path)
+        # 同一个 hunk 平铺到不同路径，路径不同所以不会命中缓存或被去重
+        new_path = os.path.join(f"services/svc{i // 100:03d}", directory, f"{i}_{file_name}")
+        large.append({"old_path": new_path, "new_path": new_path, "new_file": False, "deleted_file": False,
+                      "renamed_file": False, "diff": hunk})
+    return large
+
+
+def record_merge_request(spec):
+    """ 从 GitLab 录制一个真实 MR 的全部文件变更（被折叠的大文件已补全） """
+    sys.path.insert(0, REPO_ROOT)
+    import main
+    main.validate_config()
+    project, _, mr_iid = spec.rpartition("!")
+    return list(main.iter_changes(main.MRSession(project, mr_iid)))
+
+
+def corpus_path(name):
+    return os.path.join(CORPUS_DIR, f"{name}.json")
+
+
+def save(name, changes):
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    with open(corpus_path(name), "w", encoding="utf-8") as f:
+        json.dump(changes, f, ensure_ascii=False)
+    print(f"Wrote {corpus_path(name)}: {len(changes)} files")
+
+
+def load(name, repo=REPO_ROOT):
+    """ 读取语料；内置语料被删除时从 HEAD 重新录制缺少的这一档（其余已提交的语料不会被覆盖） """
+    if not os.path.exists(corpus_path(name)) and name in CORPUS_NAMES:
+        save(name, build_corpus(name, repo))
+    with open(corpus_path(name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record MR diff corpora for the benchmark")
+    parser.add_argument("names", nargs="*", help="要重新录制的内置语料（small / medium / large），默认全部")
+    parser.add_argument("--repo", default=REPO_ROOT, help="录制语料的 git 仓库")
+    parser.add_argument("--revision", default="HEAD", help="录制语料的提交")
+    parser.add_argument("--large-files", type=int, default=5000, help="large 语料的文件数")
+    parser.add_argument("--record", help="从 GitLab 录制 MR，格式 project!iid")
+    parser.add_argument("--name", help="--record 录制的语料名")
+    args = parser.parse_args()
+    if args.record:
+        save(args.name or args.record.replace("/", "_").replace("!", "_"), record_merge_request(args.record))
+    else:
+        unknown = set(args.names) - set(CORPUS_NAMES)
+        if unknown:
+            parser.error(f"unknown corpus: {', '.join(sorted(unknown))}")
+        for corpus_name in args.names or CORPUS_NAMES:
+            save(corpus_name, build_corpus(corpus_name, args.repo, args.revision, args.large_files))
@@ -0,0 +1,208 @@
+"""
+benchmark 使用的本地假服务，不需要真实的 GitLab 和 LLM：
+FakeGitLab 提供 MR 详情、changes / 分页 diffs、versions、discussions、notes 接口；
+FakeOpenAI 是 OpenAI 兼容的 chat.completions 接口，延迟、错误率和每个 hunk 返回的 review 条数可配置
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeServer:
+    """
+    在后台线程运行的 HTTP 服务，按 (method, 接口类型) 统计请求次数
+    """
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, "GET")
+
+            def do_POST(self):
+                fake.handle(self, "POST")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, method, kind):
+        with self._lock:
+            self.calls[(method, kind)] += 1
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def handle(self, request, method):
+        raise NotImplementedError
+
+    @staticmethod
+    def read_json(request):
+        length = int(request.headers.get("Content-Length") or 0)
+        return json.loads(request.rfile.read(length) or b"{}")
+
+    @staticmethod
+    def send_json(request, obj, status=200, headers=None):
+        body = json.dumps(obj).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class FakeGitLab(FakeServer):
+    """
+    只包含一个 MR 的 GitLab：changes 为 corpus 中的文件变更列表，发布的讨论和评论保存在内存中
+    """
+    HEAD_SHA = "b" * 40
+    BASE_SHA = "a" * 40
+
+    def __init__(self, changes, latency=0.0):
+        super().__init__()
+        self.changes = changes
+        self.latency = latency
+        self.discussions = []
+        self.notes = []
+
+    def handle(self, request, method):
+        parsed = urlparse(request.path)
+        path = parsed.path
+        query = parse_qs(parsed.query)
+        if self.latency:
+            time.sleep(self.latency)
+        mr = re.fullmatch(r"/api/v4/projects/([^/]+)/merge_requests/(\d+)(/.*)?", path)
+        if not mr:
+            self.count(method, "other")
+            return self.send_json(request, {"message": "404 Not Found"}, 404)
+        kind = (mr.group(3) or "").strip("/").split("/")[0] or "merge_request"
+        self.count(method, kind)
+        if method == "GET" and kind == "merge_request":
+            return self.send_json(request, {
+                "id": 1, "iid": int(mr.group(2)), "project_id": 1, "title": "benchmark", "description": "",
+                "state": "opened", "sha": self.HEAD_SHA,
+                "diff_refs": {"base_sha": self.BASE_SHA, "start_sha": self.BASE_SHA, "head_sha": self.HEAD_SHA},
+            })
+        if method == "GET" and kind == "changes":
+            return self.send_json(request, {"iid": int(mr.group(2)), "changes": self.changes, "overflow": False})
+        if method == "GET" and kind == "diffs":
+            page = int(query.get("page", ["1"])[0])
+            per_page = int(query.get("per_page", ["20"])[0])
+            headers = {}
+            if page * per_page < len(self.changes):
+                headers["Link"] = f'<{self.url}{path}?page={page + 1}&per_page={per_page}>; rel="next"'
+            return self.send_json(request, self.changes[(page - 1) * per_page:page * per_page], headers=headers)
+        if method == "GET" and kind == "versions":
+            return self.send_json(request, [{"id": 1, "head_commit_sha": self.HEAD_SHA}])
+        if method == "GET" and kind == "discussions":
+            return self.send_json(request, self.discussions)
+        if method == "POST" and kind == "discussions":
+            body = self.read_json(request)
+            discussion = {"id": str(len(self.discussions) + 1),
+                          "notes": [{"body": body.get("body"), "position": body.get("position")}]}
+            self.discussions.append(discussion)
+            return self.send_json(request, discussion, 201)
+        if method == "POST" and kind == "notes":
+            body = self.read_json(request)
+            note = {"id": len(self.notes) + 1, "body": body.get("body")}
+            self.notes.append(note)
+            return self.send_json(request, note, 201)
+        return self.send_json(request, {"message": "404 Not Found"}, 404)
+
+
+HUNK_HEADER = re.compile(r'^Hunk (\d+) in file "[^"]*":', re.MULTILINE)
+CHANGE_LINE = re.compile(r"^old_line:(\d+), new_line:(\d+), action:(Add|Modify|Delete)", re.MULTILINE)
+
+
+class FakeOpenAI(FakeServer):
+    """
+    OpenAI 兼容的 chat.completions 接口
+    latency 为平均延迟（秒，按 ±jitter 比例均匀抖动），error_rate 为返回 429 的概率，
+    reviews_per_hunk 为每个 hunk 返回的 review 条数（取 prompt 中的前几个变更行），comment_size 为每条评论的字数
+    """
+    def __init__(self, latency=0.0, jitter=0.5, error_rate=0.0, reviews_per_hunk=1, comment_size=80, seed=0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reviews_per_hunk = reviews_per_hunk
+        self.comment_size = comment_size
+        self._random = random.Random(seed)
+
+    def handle(self, request, method):
+        if method != "POST" or not request.path.endswith("/chat/completions"):
+            self.count(method, "other")
+            return self.send_json(request, {"error": {"message": "not found"}}, 404)
+        self.count(method, "chat.completions")
+        body = self.read_json(request)
+        with self._lock:
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+            failed = self._random.random() < self.error_rate
+        time.sleep(max(0.0, delay))
+        if failed:
+            return self.send_json(request, {"error": {"message": "rate limited"}}, 429, {"Retry-After": "0"})
+
+        prompt = body["messages"][-1]["content"]
+        content = json.dumps({"reviews": self.reviews(prompt)}, ensure_ascii=False)
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in body["messages"]) // 4,
+                 "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if body.get("stream"):
+            return self.send_stream(request, body, content, usage)
+        return self.send_json(request, {
+            "id": "fake", "object": "chat.completion", "created": 0, "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def reviews(self, prompt):
+        headers = list(HUNK_HEADER.finditer(prompt))
+        reviews = []
+        for index, header in enumerate(headers):
+            end = headers[index + 1].start() if index + 1 < len(headers) else len(prompt)
+            lines = CHANGE_LINE.findall(prompt, header.end(), end)
+            for old_line, new_line, action in lines[:self.reviews_per_hunk]:
+                reviews.append({
+                    "hunk_id": int(header.group(1)), "old_line": int(old_line), "new_line": int(new_line),
+                    "action": action, "reviewComment": ("benchmark review " * self.comment_size)[:self.comment_size],
+                })
+        return reviews
+
+    def send_stream(self, request, body, content, usage):
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.end_headers()
+        for start in range(0, len(content), 32):
+            event = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": content[start:start + 32]}, "finish_reason": None}]}
+            request.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+        if (body.get("stream_options") or {}).get("include_usage"):
+            event = {"id": "fake", "object": "chat.completion.chunk", "created": 0, "model": body.get("model"),
+                     "choices": [], "usage": usage}
+            request.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+        request.wfile.write(b"data: [DONE]\n\n")
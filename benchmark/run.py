@@ -0,0 +1,125 @@
+"""
+离线 benchmark：用本地假 GitLab / 假 OpenAI 服务跑完整的 start_ai_code_review，
+报告端到端耗时、LLM 调用数、GitLab 调用数、峰值 RSS 以及各阶段耗时的 p50 / p95（取自 main.metrics）。
+假服务和语料留在 benchmark 进程中，main.py 每个语料在单独的子进程中运行，峰值 RSS 只包含 main.py 本身
+
+用法：python benchmark/run.py [--corpus small,medium,large] [--latency 0.05] [--error-rate 0.02]
+     python benchmark/run.py --corpus large --env INPUT_PACK_TOKENS=3000 --json bench.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import corpus  # noqa: E402
+from fakes import FakeGitLab, FakeOpenAI  # noqa: E402
+
+
+def run_worker():
+    """ 子进程：用父进程设置的环境变量跑一次 main.py，返回 main.py 自身的耗时、峰值 RSS 和运行指标 """
+    sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+    import main
+
+    main.validate_config()
+    start = time.perf_counter()
+    main.start_ai_code_review("benchmark", "1", "1")
+    wall = time.perf_counter() - start
+    # 各阶段耗时和计数器来自 main.py 内置的运行指标
+    report = main.metrics.report()
+    return {
+        "wall_s": wall,
+        # Linux 上 ru_maxrss 的单位是 KB
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": report["stages"],
+        "counters": report["counters"],
+    }
+
+
+def run_scenario(name, args):
+    """ 在当前进程中启动假服务，在子进程中跑 main.py，返回结果字典；子进程失败时返回 None """
+    changes = corpus.load(name)
+    gitlab = FakeGitLab(changes, latency=args.gitlab_latency).start()
+    llm = FakeOpenAI(latency=args.latency, error_rate=args.error_rate, reviews_per_hunk=args.reviews_per_hunk,
+                     comment_size=args.comment_size).start()
+    env = dict(os.environ, **{
+        "GITLAB_TOKEN": "benchmark", "CI_API": gitlab.url,
+        "OPENAI_API_KEY": "benchmark", "OPENAI_API_MODEL": "benchmark", "OPENAI_API_URL": f"{llm.url}/v1",
+        # 默认关闭缓存和 GitLab 写接口限流（300 次/分钟会让大语料的耗时全部花在等待令牌上），可用 --env 覆盖
+        "INPUT_CACHE_PATH": "", "INPUT_EXCLUDE": "", "INPUT_GITLAB_RPM": "0",
+    })
+    env.update(dict(item.split("=", 1) for item in args.env))
+    try:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker"], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    finally:
+        gitlab.stop()
+        llm.stop()
+    if completed.returncode != 0:
+        print(f"\n== {name}: benchmark failed (exit code {completed.returncode}) ==")
+        print("\n".join(completed.stderr.splitlines()[-20:]))
+        return None
+    worker = json.loads(completed.stdout)
+    return {
+        "corpus": name,
+        "files": len(changes),
+        "wall_s": worker["wall_s"],
+        "llm_calls": llm.total_calls(),
+        "gitlab_calls": gitlab.total_calls(),
+        "gitlab_calls_by_endpoint": {f"{method} {kind}": count for (method, kind), count in sorted(gitlab.calls.items())},
+        "comments_posted": len(gitlab.discussions),
+        "peak_rss_mb": worker["peak_rss_mb"],
+        "stages": worker["stages"],
+        "counters": worker["counters"],
+    }
+
+
+def print_result(result):
+    print(f"\n== {result['corpus']}: {result['files']} files ==")
+    print(f"wall {result['wall_s']:.2f} s, LLM calls {result['llm_calls']}, GitLab calls {result['gitlab_calls']}, "
+          f"comments {result['comments_posted']}, peak RSS {result['peak_rss_mb']:.1f} MB")
+    print(f"{'stage':<16}{'count':>8}{'total ms':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, stats in result["stages"].items():
+        print(f"{stage:<16}{stats['count']:>8}{stats['total_ms']:>12.1f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}")
+    print("counters: " + ", ".join(f"{name}={value}" for name, value in result["counters"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for main.py")
+    parser.add_argument("--corpus", default="small,medium,large", help="逗号分隔的语料名（benchmark/corpus/<name>.json）")
+    parser.add_argument("--latency", type=float, default=0.05, help="假 LLM 的平均响应延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="假 LLM 返回 429 的概率")
+    parser.add_argument("--reviews-per-hunk", type=int, default=1, help="假 LLM 每个 hunk 返回的 review 条数")
+    parser.add_argument("--comment-size", type=int, default=80, help="每条 review 评论的字数")
+    parser.add_argument("--gitlab-latency", type=float, default=0.0, help="假 GitLab 每个请求的延迟（秒）")
+    parser.add_argument("--env", action="append", default=[], help="传给 main.py 的环境变量，如 INPUT_CONCURRENCY=8")
+    parser.add_argument("--json", help="把所有结果写入该 JSON 文件")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # 子进程：main.py 的日志输出到 stderr，stdout 只输出结果 JSON
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        stdout.write(json.dumps(run_worker()))
+        return
+
+    results = []
+    for name in [n.strip() for n in args.corpus.split(",") if n.strip()]:
+        result = run_scenario(name, args)
+        if result is None:
+            continue
+        results.append(result)
+        print_result(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
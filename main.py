@@ -1,37 +1,194 @@
 import os
 import sys
 import json
+import math
 import fnmatch
-import requests
-import openai
-from unidiff import PatchSet
-from zhipuai import ZhipuAI
+import importlib
+import subprocess
 import re
-import gitlab
+import argparse
 import hashlib
+import difflib
+import ast
+import io
+import tokenize
+import textwrap
+import functools
+import threading
+import random
+import sqlite3
+import time
+import contextlib
+import contextvars
+import datetime
+import gzip
+import base64
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
-# 从环境变量中读取必要的参数
+class LazyModule:
+    """
+    首次访问属性时才导入的模块代理：openai / gitlab / requests / unidiff 导入较慢，
+    只在真正用到时才导入，导入本模块、校验配置和没有 diff 的运行都不需要等待它们
+    """
+    def __init__(self, name):
+        self._name = name
+
+    @property
+    def loaded(self):
+        return self._name in sys.modules
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+openai = LazyModule("openai")
+gitlab = LazyModule("gitlab")
+requests = LazyModule("requests")
+unidiff = LazyModule("unidiff")
+
+# 从环境变量中读取必要的参数（由 validate_config 在入口处校验）
 GITLAB_TOKEN = os.getenv("GITLAB_TOKEN")
-if not GITLAB_TOKEN:
-    raise ValueError("GITLAB_TOKEN is not set")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise ValueError("OPENAI_API_KEY is not set")
 OPENAI_API_MODEL = os.getenv("OPENAI_API_MODEL")
-if not OPENAI_API_MODEL:
-    raise ValueError("OPENAI_API_MODEL is not set")
 OPENAI_API_URL = os.getenv("OPENAI_API_URL")
-if not OPENAI_API_URL:
-    raise ValueError("OPENAI_API_URL is not set")
 
 # GitLab API 的基本地址（默认指向 gitlab.com，如为私有部署请设置 CI_API_V4_URL 环境变量）
 CI_API_V4_URL = os.getenv("CI_API_V4_URL", "https://gitlab.com/api/v4")
 CI_API = os.getenv("CI_API", "https://gitlab.com")
-client = openai.OpenAI(
-    base_url=OPENAI_API_URL,
-    api_key=OPENAI_API_KEY
-)
-gl = gitlab.Gitlab(CI_API, private_token=GITLAB_TOKEN)
+# 并发调用 LLM 的最大 worker 数（同时在途的 hunk review 请求数）
+REVIEW_CONCURRENCY = max(1, int(os.getenv("INPUT_CONCURRENCY", "4")))
+# review 缓存（SQLite 文件，设置为空字符串则关闭缓存）及其过期时间（秒）和最大条目数
+REVIEW_CACHE_PATH = os.getenv("INPUT_CACHE_PATH", ".ai_review_cache.sqlite")
+REVIEW_CACHE_TTL = int(os.getenv("INPUT_CACHE_TTL", str(7 * 24 * 3600)))
+REVIEW_CACHE_MAX_ENTRIES = int(os.getenv("INPUT_CACHE_MAX_ENTRIES", "10000"))
+# 增量 review：只 review 上次 review 过的 head_sha 之后新提交改动到的 hunk（依赖 review 缓存记录状态）
+REVIEW_INCREMENTAL = os.getenv("INPUT_INCREMENTAL", "false").lower() in ("1", "true", "yes")
+# 多个小代码块打包进同一个 prompt 时的 diff token 预算，0 表示不打包（每个代码块单独请求）
+REVIEW_PACK_TOKENS = int(os.getenv("INPUT_PACK_TOKENS", "0"))
+# 获取 MR diff 的方式：paginated 使用分页的 MR diffs 接口（GitLab 15.7+，旧版本自动回退），changes 使用一次性返回的 changes 接口
+REVIEW_DIFF_MODE = os.getenv("INPUT_DIFF_MODE", "paginated")
+REVIEW_DIFF_PAGE_SIZE = int(os.getenv("INPUT_DIFF_PAGE_SIZE", "50"))
+# 被折叠（collapsed / too_large）文件按需拉取原文件的并发数，以及单个原文件的大小上限（字节）
+REVIEW_RAW_FETCH_CONCURRENCY = max(1, int(os.getenv("INPUT_RAW_FETCH_CONCURRENCY", "4")))
+REVIEW_MAX_RAW_FILE_BYTES = int(os.getenv("INPUT_MAX_RAW_FILE_BYTES", str(1024 * 1024)))
+# 单个代码块的 token 上限，超过时按行切分为互相重叠的窗口；窗口间重叠的行数
+REVIEW_MAX_CHUNK_TOKENS = int(os.getenv("INPUT_MAX_CHUNK_TOKENS", "6000"))
+REVIEW_CHUNK_OVERLAP_LINES = int(os.getenv("INPUT_CHUNK_OVERLAP_LINES", "5"))
+# 单个文件的 token 硬上限，超过时整个文件跳过不 review（0 表示不限制）
+REVIEW_MAX_FILE_TOKENS = int(os.getenv("INPUT_MAX_FILE_TOKENS", "60000"))
+# 流式接收 LLM 回复，边生成边解析 reviews 并立即发布评论
+REVIEW_STREAM = os.getenv("INPUT_STREAM", "false").lower() in ("1", "true", "yes")
+# 可选的团队 review 规范，作为每个 MR 共享上下文的一部分放进 prompt
+REVIEW_GUIDELINES = os.getenv("INPUT_GUIDELINES", "")
+# 结构化输出方式：auto（自动探测，json_schema -> json_object -> none 逐级降级）、json_schema、json_object、tools、none
+RESPONSE_FORMAT_MODE = os.getenv("INPUT_RESPONSE_FORMAT", "auto")
+# 在解析 diff 之前按路径和 diff 内容排除 lock 文件、生成代码（含 .gitattributes 的 linguist-generated / linguist-vendored）、压缩文件和二进制文件
+REVIEW_EXCLUDE_GENERATED = os.getenv("INPUT_EXCLUDE_GENERATED", "true").lower() in ("1", "true", "yes")
+# 本地预过滤：跳过无实质语义变化的代码块（纯格式/注释改动、纯删除、import 重排、版本号升级）；
+# lock 文件和生成代码由 INPUT_EXCLUDE_GENERATED 在解析 diff 之前排除
+REVIEW_SKIP_TRIVIAL = os.getenv("INPUT_SKIP_TRIVIAL", "true").lower() in ("1", "true", "yes")
+# CI 时间预算（秒，0 表示不限制）：开启后按风险优先级 review，预算将尽时停止发起新请求，
+# 最后 TIME_BUDGET_RESERVE 秒（最多预算的一半）留给在途请求收尾和发布总结：LLM 请求的超时截止在预留时间的一半处，
+# 剩下的一半保证总结能够发布
+REVIEW_TIME_BUDGET = float(os.getenv("INPUT_TIME_BUDGET", "0"))
+TIME_BUDGET_RESERVE = float(os.getenv("INPUT_TIME_BUDGET_RESERVE", "30"))
+# 限流：LLM 每个后端每分钟请求数 / token 数（INPUT_LLM_BACKENDS 中可按后端覆盖）、GitLab 写接口每分钟请求数（0 表示不限制）
+LLM_REQUESTS_PER_MIN = int(os.getenv("INPUT_LLM_RPM", "0"))
+LLM_TOKENS_PER_MIN = int(os.getenv("INPUT_LLM_TPM", "0"))
+GITLAB_REQUESTS_PER_MIN = int(os.getenv("INPUT_GITLAB_RPM", "300"))
+# 可重试错误（429 / 5xx / 超时）的最大重试次数，以及熔断：连续 5xx / 超时 / 连接错误次数阈值（429 不计入）和熔断持续秒数
+MAX_RETRIES = int(os.getenv("INPUT_MAX_RETRIES", "5"))
+BREAKER_FAILURES = int(os.getenv("INPUT_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("INPUT_BREAKER_RESET_SECONDS", "30"))
+# 批量模式下同时 review 的 MR 数（代码块共享同一个 INPUT_CONCURRENCY 大小的线程池）
+BATCH_MR_CONCURRENCY = max(1, int(os.getenv("INPUT_BATCH_MR_CONCURRENCY", "2")))
+# prompt 模板、解析逻辑或缓存格式变化时递增，使旧的缓存结果失效
+PROMPT_VERSION = "3"
+# 导入本模块时间（python -X importtime）的预算，单位毫秒，用于 --import-time-budget 检查
+IMPORT_TIME_BUDGET_MS = float(os.getenv("INPUT_IMPORT_TIME_BUDGET_MS", "150"))
+# 运行结束时写出 JSON 运行报告（各阶段耗时、token、缓存命中、重试、丢弃的代码块）/ OpenMetrics 文本的路径，为空则不写
+METRICS_REPORT_PATH = os.getenv("INPUT_METRICS_REPORT", "")
+METRICS_OPENMETRICS_PATH = os.getenv("INPUT_METRICS_OPENMETRICS", "")
+# OTLP（gRPC）collector 地址，如 http://localhost:4317；设置后各阶段作为 OpenTelemetry span 导出（需要 opentelemetry-sdk）
+OTLP_ENDPOINT = os.getenv("INPUT_OTLP_ENDPOINT", "")
+# 录制 / 回放：record 时把 GitLab 和 LLM 的请求与响应写入 cassette 目录，replay 时完全从 cassette 离线重放（off 关闭）
+CASSETTE_MODE = os.getenv("INPUT_CASSETTE_MODE", "off").lower()
+CASSETTE_DIR = os.getenv("INPUT_CASSETTE_DIR", ".ai_review_cassettes")
+# 多个 OpenAI 兼容 endpoint 组成的后端池（JSON 列表，每项可含 name / url / model / api_key / weight / rpm / tpm，
+# 未填的字段使用 OPENAI_API_URL / OPENAI_API_MODEL / OPENAI_API_KEY），为空时只使用 OPENAI_API_URL 一个后端
+LLM_BACKENDS = os.getenv("INPUT_LLM_BACKENDS", "")
+# 对冲请求：请求超过所选后端近期延迟的 p95（不低于 LLM_HEDGE_MIN_DELAY 秒）仍未返回时，向另一个后端再发一次，先返回的生效
+LLM_HEDGE = os.getenv("INPUT_LLM_HEDGE", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_MIN_DELAY = float(os.getenv("INPUT_LLM_HEDGE_MIN_DELAY", "1"))
+# 模型分级：设置小模型后按复杂度路由，简单的代码块发给小模型，复杂度分数达到阈值或路径敏感的代码块仍发给 OPENAI_API_MODEL
+CASCADE_SMALL_MODEL = os.getenv("INPUT_SMALL_MODEL", "")
+CASCADE_THRESHOLD = float(os.getenv("INPUT_CASCADE_THRESHOLD", "20"))
+# 小模型回复的 confidence（0~1）低于该值时改由大模型重新 review，0 表示不升级（小模型的结果直接发布）
+CASCADE_ESCALATE_BELOW = float(os.getenv("INPUT_CASCADE_ESCALATE_BELOW", "0"))
+
+def validate_config():
+    """
+    校验必需的环境变量，缺失时抛出 ValueError；回放模式不访问真实 endpoint，只需要 OPENAI_API_MODEL（请求指纹的一部分）
+    """
+    if CASSETTE_MODE not in CASSETTE_MODES:
+        raise ValueError(f"INPUT_CASSETTE_MODE must be one of {', '.join(CASSETTE_MODES)}, got {CASSETTE_MODE!r}")
+    required = (("GITLAB_TOKEN", GITLAB_TOKEN), ("OPENAI_API_MODEL", OPENAI_API_MODEL))
+    if LLM_BACKENDS:
+        load_llm_backends()  # 每个后端的 url / api_key 缺失时抛出 ValueError
+    else:
+        required += (("OPENAI_API_KEY", OPENAI_API_KEY), ("OPENAI_API_URL", OPENAI_API_URL))
+    if CASSETTE_MODE == "replay":
+        required = (("OPENAI_API_MODEL", OPENAI_API_MODEL),)
+        if not os.path.isdir(CASSETTE_DIR):
+            raise ValueError(f"Cassette directory {CASSETTE_DIR} does not exist, record it first")
+    for name, value in required:
+        if not value:
+            raise ValueError(f"{name} is not set")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _shared_client(name, factory):
+    # 客户端在第一次使用时才创建，之后整个进程（包括所有 worker 线程）复用同一个实例
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+def get_llm_pool():
+    return _shared_client("llm_pool", lambda: LLMPool(load_llm_backends(), hedge=LLM_HEDGE))
+
+def get_gitlab_client():
+    return _shared_client("gitlab", create_gitlab_client)
+
+def create_gitlab_client():
+    """
+    构造 GitLab 客户端，整个运行期间复用同一个带连接池的 keep-alive HTTP session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(10, REVIEW_CONCURRENCY))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    request = session.request
+    if cassette:
+        request = functools.partial(cassette.gitlab_request, request)
+    session.request = functools.partial(traced_gitlab_request, request)
+    return gitlab.Gitlab(CI_API, private_token=GITLAB_TOKEN, session=session)
+
+# python-gitlab 的异常不带响应头，429 响应的 Retry-After 按线程记下，供 retry_after_seconds 读取
+_gitlab_throttle = threading.local()
+
+def traced_gitlab_request(request, method, url, *args, **kwargs):
+    # 按 HTTP 方法统计 GitLab 请求数；读请求（MR 详情、diff、原文件、已有讨论）计入 fetch 阶段，写请求在 publish 阶段计时
+    metrics.incr(f"gitlab_requests_{method.lower()}")
+    if method.upper() != "GET":
+        response = request(method, url, *args, **kwargs)
+    else:
+        with metrics.span("fetch", **{"http.method": method, "http.url": url.split("?")[0]}):
+            response = request(method, url, *args, **kwargs)
+    _gitlab_throttle.retry_after = response.headers.get("Retry-After") if response.status_code == 429 else None
+    return response
 
 # client = ZhipuAI(api_key=xxx)
 # openai.api_key = OPENAI_API_KEY
@@ -41,41 +198,85 @@ gl = gitlab.Gitlab(CI_API, private_token=GITLAB_TOKEN)
 # 用于构造解析 diff 的数据结构
 #############################################
 class DiffChange:
+    __slots__ = ("ln", "ln2", "content")
+
     def __init__(self, ln, ln2, content):
         self.ln = ln         # 新增行号（如果存在）
         self.ln2 = ln2       # 原始行号（当新增行号不存在时使用）
         self.content = content
 
 class DiffChunk:
-    def __init__(self, content, changes):
-        self.content = content  # 包含 hunk 头和具体代码行
+    __slots__ = ("header", "changes", "owned_from")
+
+    def __init__(self, header, changes, owned_from=0):
+        self.header = header    # hunk 头（section header）
         self.changes = changes  # 列表，每一项为 DiffChange 对象
+        self.owned_from = owned_from  # 切分窗口开头与上一个窗口重叠、只作上下文的行数
+
+    @property
+    def owned_changes(self):
+        # 由本代码块负责评论的行，重叠的上下文行由上一个窗口负责
+        return self.changes[self.owned_from:]
+
+    @property
+    def content(self):
+        # 包含 hunk 头和具体代码行；按需由 changes 拼出，不重复存储每行文本
+        return self.header + "\n" + "".join(c.content + "\n" for c in self.changes)
 
 class DiffFile:
+    __slots__ = ("to", "chunks", "_line_index")
+
     def __init__(self, to, chunks):
         self.to = to         # 目标文件路径
         self.chunks = chunks # 当前文件中的所有代码块
+        self._line_index = None
+
+    @property
+    def line_index(self):
+        """
+        文件内所有变更行的索引，首次访问时构建：
+        pairs 以 (old_line, new_line) 为 key（不存在的一侧为 0），new / old 分别以单侧行号为 key，值均为 DiffChange
+        """
+        if self._line_index is None:
+            pairs, new, old = {}, {}, {}
+            for chunk in self.chunks:
+                for c in chunk.changes:
+                    pairs[(c.ln2 or 0, c.ln or 0)] = c
+                    if c.ln is not None:
+                        new[c.ln] = c
+                    if c.ln2 is not None:
+                        old[c.ln2] = c
+            self._line_index = {"pairs": pairs, "new": new, "old": old}
+        return self._line_index
+
+    def locate(self, old_line, new_line):
+        """
+        O(1) 查找 AI 返回的行号对应的 DiffChange：先精确匹配 (old_line, new_line)，
+        再分别按 new_line、old_line 匹配；都不存在（模型编造的行号）时返回 None
+        """
+        index = self.line_index
+        return (index["pairs"].get((old_line, new_line))
+                or (index["new"].get(new_line) if new_line else None)
+                or (index["old"].get(old_line) if old_line else None))
 
 def parse_diff(diff_text):
     """
     利用 unidiff 库将 diff 字符串解析为 DiffFile 列表
     """
-    patch = PatchSet(diff_text.splitlines(keepends=True))
+    patch = unidiff.PatchSet(diff_text.splitlines(keepends=True))
     diff_files = []
     for patched_file in patch:
         target = patched_file.target_file
         chunks = []
         for hunk in patched_file:
             header = hunk.section_header.strip() if hunk.section_header else ""
-            lines_text = "".join([line.value for line in hunk])
-            chunk_content = header + "\n" + lines_text
             changes = []
             for line in hunk:
                 # 使用新增行号（target_line_no）为主，否则使用原始行号（source_line_no）
                 ln = line.target_line_no
                 ln2 = line.source_line_no
                 changes.append(DiffChange(ln, ln2, line.value.rstrip("\n")))
-            chunks.append(DiffChunk(chunk_content, changes))
+            chunks.append(DiffChunk(header, changes))
         diff_files.append(DiffFile(target, chunks))
     return diff_files
 
@@ -83,180 +284,2423 @@ def parse_diff(diff_text):
 #############################################
 # GitLab API 相关函数
 #############################################
-def get_pr_details(project_id=None, mr_iid=None, ):
+class MRSession:
     """
-    从环境变量中获取项目 ID 和 Merge Request IID，
-    并通过 GitLab API 获取 MR 的标题、描述以及 diff refs（用于评论定位）
+    一次 review 运行共享的 Merge Request 上下文
+    project、MR、diff_refs 和 changes 只在首次访问时拉取一次，之后各阶段直接复用
     """
+    def __init__(self, project_id, mr_iid, gl_client=None):
+        if not project_id or not mr_iid:
+            raise ValueError("CI_PROJECT_ID and CI_MERGE_REQUEST_IID must be set")
+        self.project_id = project_id
+        self.mr_iid = mr_iid
+        self.gl = gl_client or get_gitlab_client()
+        self._lock = threading.Lock()
+        self._project = None
+        self._mr = None
+        self._changes = None
+        # diff 获取过程中的完整性报告：overflow 表示 GitLab 截断了 diff，unreviewed 为无法获取 diff 的文件
+        self.diff_report = {"overflow": False, "unreviewed": []}
+
+    @property
+    def project(self):
+        # lazy=True 不发请求，只构造后续调用所需的对象
+        with self._lock:
+            if self._project is None:
+                self._project = self.gl.projects.get(self.project_id, lazy=True)
+            return self._project
 
-    if not project_id or not mr_iid:
-        raise ValueError("CI_PROJECT_ID and CI_MERGE_REQUEST_IID must be set")
-    project = gl.projects.get(project_id)
-    mr = project.mergerequests.get(mr_iid)
-    diff_refs = mr.diff_refs
+    @property
+    def mr(self):
+        project = self.project
+        with self._lock:
+            if self._mr is None:
+                self._mr = project.mergerequests.get(self.mr_iid)
+            return self._mr
+
+    @property
+    def diff_refs(self):
+        return self.mr.diff_refs
+
+    def changes(self):
+        mr = self.mr
+        with self._lock:
+            if self._changes is None:
+                self._changes = mr.changes()
+            return self._changes
+
+
+def get_pr_details(session):
+    """
+    通过 MR session 获取 MR 的标题、描述以及 diff refs（用于评论定位）
+    """
+    mr = session.mr
+    diff_refs = session.diff_refs
 
     return {
-        "project_id": project_id,
-        "mr_iid": mr_iid,
+        "project_id": session.project_id,
+        "mr_iid": session.mr_iid,
         "title": mr.title,
         "description": mr.description,
         "base_sha": diff_refs.get("base_sha"),
         "start_sha": diff_refs.get("start_sha"),
-        "head_sha": diff_refs.get("head_sha")
+        "head_sha": diff_refs.get("head_sha"),
+        "session": session,
+        # 本 MR 的 LLM 用量；批量 / 服务模式下多个 MR 并发 review，不能用全局计数的差值
+        "usage": LLMUsage()
     }
 
 
-def get_diff(project_id, mr_iid):
+def iter_changes(session, mode=None, skip=None):
     """
-    获取 Merge Request 的 diff，调用 .diff 接口返回 raw diff 文本
+    逐个产出 Merge Request 的文件变更（change 字典）。
+    paginated 模式逐页读取 MR diffs 接口，不会被截断；被折叠的大文件以有界并发按需拉取原文件补全 diff，
+    产出顺序与接口返回顺序一致。changes 模式使用一次性返回的 changes 接口，超大 MR 会被 GitLab 截断（overflow）。
+    skip(change) 为真的文件直接丢弃，被折叠时也不会去拉取原文件
     """
-    project = gl.projects.get(project_id)
-    data = project.mergerequests.get(mr_iid).changes()
+    mode = mode or REVIEW_DIFF_MODE
+    if mode == "paginated":
+        try:
+            pages = iter_diff_pages(session)
+            if skip is not None:
+                pages = (change for change in pages if not skip(change))
+            first = next(pages, None)
+        except gitlab.exceptions.GitlabHttpError as e:
+            if e.response_code != 404:
+                raise
+            print("Paginated MR diffs API unavailable, falling back to changes API")
+        else:
+            if first is not None:
+                yield from complete_collapsed_changes(session, _prepend(first, pages))
+            return
 
-    unified_diff = ""
+    data = session.changes()
+    if data.get("overflow"):
+        session.diff_report["overflow"] = True
     for change in data["changes"]:
-        diff = change["diff"]
-        old_path = change["old_path"]
-        new_path = change["new_path"]
-        # 如果 diff 直接以 hunk 开头，则添加必要的文件头信息
-        if diff.lstrip().startswith('@@'):
-            header = (
-                f"diff --git {old_path} {new_path}\n"
-                f"--- {old_path}\n"
-                f"+++ {new_path}\n"
-            )
-            diff = header + diff
-        unified_diff += diff + "\n"
-    return unified_diff if unified_diff.strip() else None
+        if skip is None or not skip(change):
+            yield change
+
+
+def _prepend(first, rest):
+    yield first
+    yield from rest
+
+
+def iter_diff_pages(session):
+    """
+    以生成器方式逐页读取 GET /projects/:id/merge_requests/:iid/diffs，每次只在内存中保留一页
+    """
+    path = f"{session.mr.manager.path}/{session.mr_iid}/diffs"
+    return iter(session.gl.http_list(path, iterator=True, per_page=REVIEW_DIFF_PAGE_SIZE))
+
+
+def is_collapsed(change):
+    """
+    GitLab 对过大的文件只返回空 diff 并标记 collapsed / too_large
+    """
+    return not change.get("diff") and not change.get("deleted_file") and bool(
+        change.get("collapsed") or change.get("too_large")
+    )
+
+
+def complete_collapsed_changes(session, changes):
+    """
+    对被折叠的文件用线程池并发拉取原文件补全 diff（最多 REVIEW_RAW_FETCH_CONCURRENCY 个在途），
+    其余文件直接透传；按输入顺序产出
+    """
+    window = deque()
+    with ThreadPoolExecutor(max_workers=REVIEW_RAW_FETCH_CONCURRENCY) as executor:
+        for change in changes:
+            if is_collapsed(change):
+                window.append(executor.submit(metrics.bind(fetch_raw_diff), session, change))
+            else:
+                window.append(change)
+            # 队首已就绪或在途请求过多时向下游产出，保持顺序且内存有界
+            while window and (not hasattr(window[0], "result") or window[0].done()
+                              or len(window) > REVIEW_RAW_FETCH_CONCURRENCY * 2):
+                change = _resolve(window.popleft())
+                if change is not None:
+                    yield change
+        while window:
+            change = _resolve(window.popleft())
+            if change is not None:
+                yield change
+
+
+def _resolve(item):
+    return item.result() if hasattr(item, "result") else item
+
+
+def fetch_raw_diff(session, change):
+    """
+    拉取被折叠文件在 base / head 的原文件，在本地用 difflib 生成 hunk；
+    原文件过大、为二进制或拉取失败时记入 session.diff_report 并返回 None
+    """
+    path = change["new_path"]
+    try:
+        old = b"" if change.get("new_file") else session.project.files.raw(
+            file_path=change["old_path"], ref=session.diff_refs["base_sha"])
+        new = session.project.files.raw(file_path=path, ref=session.diff_refs["head_sha"])
+        if max(len(old), len(new)) > REVIEW_MAX_RAW_FILE_BYTES:
+            raise ValueError(f"file larger than {REVIEW_MAX_RAW_FILE_BYTES} bytes")
+        old_lines = old.decode("utf-8").splitlines(keepends=True)
+        new_lines = new.decode("utf-8").splitlines(keepends=True)
+    except (gitlab.exceptions.GitlabError, UnicodeDecodeError, ValueError) as e:
+        print(f"Cannot fetch full diff for {path}: {e}")
+        session.diff_report["unreviewed"].append(path)
+        return None
+    hunks = list(difflib.unified_diff(old_lines, new_lines, n=3))[2:]  # 去掉 ---/+++ 文件头
+    change = dict(change)
+    change["diff"] = "".join(line if line.endswith("\n") else line + "\n" for line in hunks)
+    return change
+
+
+def iter_diff_files(session, matcher=None):
+    """
+    流式 diff 流水线：逐个文件变更先按删除状态和 ExcludeMatcher 过滤，再单独解析为 DiffFile 产出，
+    不拼接整个 MR 的 diff 文本，被排除的文件不会被解析，被折叠时也不会拉取原文件
+    """
+    matcher = matcher or ExcludeMatcher()
+
+    def skip(change):
+        # 忽略已删除的文件和被排除的文件
+        return change.get("deleted_file") or matcher(change)
+
+    for change in iter_changes(session, skip=skip):
+        file = parse_change(change)
+        if file is not None:
+            yield file
+
+
+def parse_change(change):
+    """
+    将单个文件变更解析为 DiffFile，diff 为空（如二进制文件）时返回 None
+    """
+    with metrics.span("parse"):
+        diff = change_to_diff(change)
+        if not diff.strip():
+            return None
+        files = parse_diff(diff)
+        return files[0] if files else None
+
+
+def change_to_diff(change):
+    """
+    将 GitLab changes/compare 接口返回的单个文件变更转换为带文件头的 diff 文本
+    """
+    diff = change["diff"]
+    old_path = change["old_path"]
+    new_path = change["new_path"]
+    # 如果 diff 直接以 hunk 开头，则添加必要的文件头信息
+    if diff.lstrip().startswith('@@'):
+        header = (
+            f"diff --git {old_path} {new_path}\n"
+            f"--- {old_path}\n"
+            f"+++ {new_path}\n"
+        )
+        diff = header + diff
+    return diff
+
+
+def get_incremental_lines(session, since_sha, head_sha):
+    """
+    通过 MR versions 和 compare 接口计算 since_sha..head_sha 之间新提交改动到的行，
+    返回 {文件路径: 新文件中的行号集合}，值为 None 表示该文件无法逐行比较（如过大），需要整体 review。
+    since_sha 不是该 MR 的历史版本（如 force push 改写了历史）时返回 None，调用方应退回全量 review
+    """
+    versions = session.mr.diffs.list(get_all=True)
+    if since_sha not in {version.head_commit_sha for version in versions}:
+        return None
+    compare = session.project.repository_compare(since_sha, head_sha)
+    touched = {}
+    for change in compare["diffs"]:
+        diff = change_to_diff(change)
+        if not diff.strip():
+            touched[change["new_path"]] = None
+            continue
+        for patched_file in unidiff.PatchSet(diff.splitlines(keepends=True)):
+            lines = touched.setdefault(patched_file.target_file, set())
+            for hunk in patched_file:
+                # 删除的行记在其后一行（新文件中的位置）上
+                last_target = hunk.target_start - 1
+                for line in hunk:
+                    if line.is_added:
+                        lines.add(line.target_line_no)
+                    elif line.is_removed:
+                        lines.add(last_target + 1)
+                    if line.target_line_no is not None:
+                        last_target = line.target_line_no
+    return touched
+
+
+def filter_incremental(parsed_diff, touched):
+    """
+    只保留包含新提交改动行的文件和代码块（生成器，可直接接在流式 diff 流水线后）
+    """
+    for file in parsed_diff:
+        if file.to not in touched:
+            continue
+        lines = touched[file.to]
+        if lines is None:
+            yield file
+            continue
+        chunks = [
+            chunk for chunk in file.chunks
+            if any(change.ln in lines for change in chunk.changes if change.ln is not None)
+        ]
+        if chunks:
+            yield DiffFile(file.to, chunks)
+
+
+#############################################
+# 本地预过滤：排除无需 review 的文件和代码块
+#############################################
+LOCKFILES = {
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml", "bun.lockb", "poetry.lock",
+    "Pipfile.lock", "uv.lock", "pdm.lock", "Cargo.lock", "go.sum", "composer.lock", "Gemfile.lock", "mix.lock",
+    "pubspec.lock", "packages.lock.json", "gradle.lockfile", "flake.lock", "Podfile.lock",
+}
+DEPENDENCY_MANIFEST = re.compile(
+    r"(^|/)(requirements[^/]*\.(txt|in)|constraints[^/]*\.txt|package\.json|pyproject\.toml|setup\.(py|cfg)|Pipfile"
+    r"|go\.mod|Cargo\.toml|Gemfile|[^/]*\.gemspec|pom\.xml|build\.gradle(\.kts)?|libs\.versions\.toml"
+    r"|[^/]*\.csproj|Directory\.Packages\.props|Chart\.yaml|VERSION|version\.txt)$")
+GENERATED_MARKER = re.compile(r"@generated|do not edit|auto-?generated|code generated by", re.IGNORECASE)
+IMPORT_LINE = re.compile(r"^\s*(import\s|from\s+\S+\s+import\s|#\s*include\s|using\s+[\w.]+\s*;|use\s+[\w:\\]+|"
+                         r"(const|let|var)\s+.+=\s*require\()")
+VERSION_NUMBER = re.compile(r"v?\d+(\.\d+)+([-+.]?[0-9A-Za-z]+)*")
+# 版本号替换为 <v> 后的依赖 / 版本声明行：version 键、带比较符或引号的依赖约束、go.mod / Gradle 坐标、纯版本号文件
+DEPENDENCY_LINE = re.compile(
+    r"version\w*[\"']?\s*[:=]|<version>|"
+    r"(===?|>=|<=|~=|!=|~>|\^|~)\s*<v>|[@:]<v>|"
+    r"[\"'][=<>~^!\s]*<v>|"
+    r"^(require\s+)?[\w.\-/]+\s+<v>(\s*//.*)?$|"
+    r"^<v>$", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+STRING_LITERAL = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`')
+# 括号内侧和逗号、分号前的空白不影响 token 划分
+TIGHT_SPACE = re.compile(r"(?<=[(\[{])\s+|\s+(?=[)\]},;])")
+BINARY_EXTENSIONS = {
+    ".png", ".jpg", ".jpeg", ".gif", ".bmp", ".ico", ".webp", ".tiff", ".psd", ".pdf", ".zip", ".gz", ".tgz",
+    ".bz2", ".xz", ".7z", ".rar", ".jar", ".war", ".class", ".so", ".dylib", ".dll", ".exe", ".bin", ".o", ".a",
+    ".pyc", ".whl", ".woff", ".woff2", ".ttf", ".otf", ".eot", ".mp3", ".mp4", ".mov", ".avi", ".wav", ".ogg",
+    ".sqlite", ".db", ".parquet", ".pb", ".onnx", ".pt", ".h5",
+}
+GENERATED_PATH = re.compile(
+    r"(_pb2(_grpc)?\.pyi?|\.pb\.(go|cc|h)|\.pb\.gw\.go|_grpc\.pb\.go|\.generated\.\w+|_generated\.\w+|\.g\.dart"
+    r"|\.freezed\.dart|\.designer\.cs|\.g\.cs|\.snap|\.js\.map|\.css\.map)$|(^|/)__generated__/")
+MINIFIED_PATH = re.compile(r"[.-]min\.(js|mjs|css)$")
+# 超过该长度的行视为压缩/打包产物的行：前端资源文件出现一行即排除，其他文件需要 diff 中过半的行超长（见 is_minified）
+MINIFIED_LINE_LENGTH = 1000
+BUNDLE_EXTENSIONS = {".js", ".mjs", ".cjs", ".css", ".svg", ".json", ".map"}
+# 从新文件第 1 行开始的 hunk 头，用于检查文件开头的生成代码标记
+FIRST_LINE_HUNK = re.compile(r"@@ -\d+(,\d+)? \+1(,\d+)? @@")
+
+def compile_globs(patterns):
+    """
+    将 INPUT_EXCLUDE 的 glob（fnmatch 语义）一次性编译为单个正则，未配置时返回 None
+    """
+    patterns = [p for p in patterns if p]
+    if not patterns:
+        return None
+    return re.compile("|".join(fnmatch.translate(p) for p in patterns))
+
+def gitattributes_regex(pattern):
+    """
+    将 .gitattributes 的路径模式转换为正则：不含 / 的模式匹配任意目录下的文件名，
+    含 / 的模式相对仓库根目录；* 和 ? 不跨目录，** 匹配任意层目录
+    """
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            out.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            body = pattern[i + 1:end]
+            out.append("[" + ("^" + body[1:] if body.startswith("!") else body) + "]")
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return ("" if anchored else "(?:.*/)?") + "".join(out)
+
+def compile_gitattributes(text, attribute):
+    """
+    从 .gitattributes 内容中提取某个布尔属性（如 linguist-generated）的规则，编译为单个正则。
+    git 规则后出现的优先，因此按倒序拼接分支，fullmatch 命中的第一个分支即生效的规则，
+    分组名首字母 y / n 表示该规则设置 / 取消该属性
+    """
+    branches = []
+    for index, line in enumerate(text.splitlines()):
+        parts = line.strip().split()
+        if not parts or parts[0].startswith("#") or parts[0].endswith("/"):
+            continue  # 注释；以 / 结尾的目录模式不作用于其中的文件
+        for attr in parts[1:]:
+            name, _, value = attr.partition("=")
+            if name.lstrip("-!") != attribute:
+                continue
+            enabled = not name.startswith(("-", "!")) and value.lower() not in ("false", "0")
+            branches.append(f"(?P<{'y' if enabled else 'n'}{index}>{gitattributes_regex(parts[0])})")
+    if not branches:
+        return None
+    return re.compile("|".join(reversed(branches)))
+
+def load_gitattributes(session):
+    """
+    读取 MR head 上仓库根目录的 .gitattributes，不存在时返回空字符串
+    """
+    try:
+        raw = session.project.files.raw(file_path=".gitattributes", ref=session.diff_refs["head_sha"])
+    except gitlab.exceptions.GitlabError:
+        return ""
+    return raw.decode("utf-8", errors="replace")
+
+class ExcludeMatcher:
+    """
+    文件级过滤器，在解析 diff 之前只根据路径和原始 diff 文本判断：INPUT_EXCLUDE 的 glob 编译为单个正则，
+    detect_generated 时还识别 lock 文件、生成代码（含 .gitattributes 规则）、压缩文件和二进制文件。
+    调用时返回排除原因（未排除为 None），并按原因计数到 report
+    """
+    def __init__(self, patterns=(), gitattributes="", detect_generated=True):
+        self.patterns = compile_globs(patterns)
+        self.detect_generated = detect_generated
+        self.generated = compile_gitattributes(gitattributes, "linguist-generated")
+        self.vendored = compile_gitattributes(gitattributes, "linguist-vendored")
+        self.report = {}
+
+    def __call__(self, change):
+        with metrics.span("filter"):
+            reason = self.reason(change["new_path"], change.get("diff") or "")
+        if reason:
+            self.report[reason] = self.report.get(reason, 0) + 1
+            metrics.incr(f"files_excluded_{reason}")
+        return reason
+
+    def reason(self, path, diff=""):
+        if self.patterns is not None and self.patterns.match(path):
+            return "excluded"
+        if not self.detect_generated:
+            return None
+        for attribute, rules in (("generated", self.generated), ("vendored", self.vendored)):
+            match = rules.fullmatch(path) if rules is not None else None
+            if match:
+                if match.lastgroup.startswith("y"):
+                    return attribute
+                if attribute == "generated":
+                    return None  # 显式 -linguist-generated 覆盖内置的生成代码识别
+        name = os.path.basename(path)
+        if name in LOCKFILES:
+            return "lockfile"
+        if os.path.splitext(name)[1].lower() in BINARY_EXTENSIONS or diff.startswith("Binary files"):
+            return "binary"
+        if MINIFIED_PATH.search(name):
+            return "minified"
+        if GENERATED_PATH.search(path):
+            return "generated"
+        if diff:
+            if FIRST_LINE_HUNK.match(diff) and GENERATED_MARKER.search("\n".join(diff.split("\n", 6)[1:6])):
+                return "generated"
+            if is_minified(path, diff):
+                return "minified"
+        return None
+
+def is_minified(path, diff):
+    """
+    根据 diff 中的超长行判断是否为压缩/打包产物。源代码中偶尔也有很长的一行（内嵌数据、长字符串常量），
+    因此只有前端资源文件（BUNDLE_EXTENSIONS）出现一行超长即排除，其他文件需要过半的行超长
+    """
+    lines = [line for line in diff.split("\n") if line and not line.startswith("@@")]
+    long_lines = sum(1 for line in lines if len(line) > MINIFIED_LINE_LENGTH)
+    if os.path.splitext(path)[1].lower() in BUNDLE_EXTENSIONS:
+        return long_lines > 0
+    return long_lines * 2 > len(lines)
+
+def print_exclude_report(report):
+    if report:
+        details = ", ".join(f"{reason} {count}" for reason, count in sorted(report.items()))
+        print(f"Excluded {sum(report.values())} files before parsing: {details}")
+
+
+# 缩进有语义的文件：格式比较时保留每行缩进
+INDENT_SENSITIVE = (".py", ".pyi", ".yml", ".yaml", ".haml", ".pug", ".slim", ".sass", ".coffee", "Makefile", ".mk")
+
+def _normalize_code(text):
+    """
+    格式比较用的归一化：字符串字面量原样保留，其余部分的连续空白折叠为一个空格，并去掉不影响 token 划分的空白。
+    不删除全部空白，避免 `"Hello world"` 与 `"Helloworld"`、`y - -z` 与 `y --z` 被当成同一段代码
+    """
+    parts = []
+    pos = 0
+    for literal in STRING_LITERAL.finditer(text):
+        parts.append(TIGHT_SPACE.sub("", WHITESPACE.sub(" ", text[pos:literal.start()])))
+        parts.append(literal.group())
+        pos = literal.end()
+    parts.append(TIGHT_SPACE.sub("", WHITESPACE.sub(" ", text[pos:])))
+    return "".join(parts).strip()
+
+def _indented_line_key(line):
+    expanded = line.expandtabs()
+    text = _normalize_code(line)
+    return (len(expanded) - len(expanded.lstrip()), text) if text else None
+
+def _python_line_key(line):
+    """
+    Python 行的比较 key：保留缩进（缩进有语义），其余部分按 token 比较并忽略注释和空白
+    """
+    expanded = line.expandtabs()
+    indent = len(expanded) - len(expanded.lstrip())
+    try:
+        tokens = tokenize.generate_tokens(io.StringIO(line.strip() + "\n").readline)
+        text = " ".join(t.string for t in tokens if t.type not in (
+            tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER))
+    except (tokenize.TokenError, SyntaxError):
+        # 多行字符串等不完整的行，退回归一化后的文本比较
+        text = _normalize_code(line)
+    return (indent, text) if text else None
+
+def _base_indent(lines):
+    return min((len(line.expandtabs()) - len(line.expandtabs().lstrip()) for line in lines if line.strip()), default=0)
+
+def _python_ast_equal(chunk):
+    """
+    代码块的旧/新版本都能独立解析为 Python AST 时，比较两者的 AST（忽略格式、换行和注释）；
+    无法解析（代码块截在语句中间等）时返回 None。两侧的整体缩进不同（代码移入/移出了代码块）时不相等
+    """
+    old_lines = [c.content for c in chunk.changes if c.ln2 is not None]
+    new_lines = [c.content for c in chunk.changes if c.ln is not None]
+    if _base_indent(old_lines) != _base_indent(new_lines):
+        return False
+    old = textwrap.dedent("\n".join(old_lines))
+    new = textwrap.dedent("\n".join(new_lines))
+    try:
+        return ast.dump(ast.parse(old)) == ast.dump(ast.parse(new))
+    except (SyntaxError, ValueError):
+        return None
+
+def classify_chunk(path, chunk):
+    """
+    判断代码块是否没有实质语义变化，返回类别（whitespace / deletion / import_reorder / version_bump），
+    需要 LLM review 时返回 None
+    """
+    removed = [c.content for c in chunk.changes if c.ln is None and c.ln2 is not None]
+    added = [c.content for c in chunk.changes if c.ln is not None and c.ln2 is None]
+    if not added:
+        return "deletion"
+    is_python = path.endswith((".py", ".pyi"))
+    # 旧/新版本按原顺序包含上下文行，跨上下文移动的行（如 free 移到 use 之后）不会被当成格式调整
+    old_side = [c.content for c in chunk.changes if c.ln2 is not None]
+    new_side = [c.content for c in chunk.changes if c.ln is not None]
+
+    # 归一化后比较：Python 按 token 逐行比较（保留缩进、忽略注释），YAML 等缩进敏感的文件逐行比较并保留缩进，
+    # 其他语言归一化空白后整体比较（兼容重新折行）
+    if path.endswith(INDENT_SENSITIVE):
+        line_key = _python_line_key if is_python else _indented_line_key
+        old_keys = [key for key in map(line_key, old_side) if key]
+        new_keys = [key for key in map(line_key, new_side) if key]
+        if old_keys == new_keys:
+            return "whitespace"
+    elif _normalize_code("\n".join(old_side)) == _normalize_code("\n".join(new_side)):
+        return "whitespace"
+
+    old_lines = [WHITESPACE.sub(" ", line).strip() for line in removed if line.strip()]
+    new_lines = [WHITESPACE.sub(" ", line).strip() for line in added if line.strip()]
+    if all(IMPORT_LINE.match(line) for line in old_lines + new_lines) and sorted(old_lines) == sorted(new_lines):
+        return "import_reorder"
+
+    # 只认依赖清单中的依赖 / 版本声明行，普通代码里改了带小数点的数字（如 timeout=1.5）仍需 review
+    if DEPENDENCY_MANIFEST.search(path):
+        old_specs = [VERSION_NUMBER.sub("<v>", line) for line in old_lines]
+        new_specs = [VERSION_NUMBER.sub("<v>", line) for line in new_lines]
+        if old_specs == new_specs and all(DEPENDENCY_LINE.search(line) for line in old_specs):
+            return "version_bump"
+
+    # 重新折行、只改注释等跨行的格式调整：旧/新代码块都能解析时比较 AST
+    if is_python and _python_ast_equal(chunk):
+        return "whitespace"
+    return None
+
+def filter_trivial(parsed_diff, report):
+    """
+    在 LLM review 之前丢弃没有实质语义变化的代码块，按类别计数写入 report（生成器，可直接接在流式 diff 流水线后）。
+    lock 文件、生成代码等整个文件的排除只由 ExcludeMatcher 负责（受 INPUT_EXCLUDE_GENERATED 控制）
+    """
+    for file in parsed_diff:
+        path = file.to or ""
+        chunks = []
+        with metrics.span("filter"):
+            for chunk in file.chunks:
+                kind = classify_chunk(path, chunk)
+                if kind:
+                    report[kind] = report.get(kind, 0) + 1
+                    metrics.incr(f"hunks_trivial_{kind}")
+                else:
+                    chunks.append(chunk)
+        if len(chunks) == len(file.chunks):
+            yield file
+        elif chunks:
+            yield DiffFile(file.to, chunks)
+
+def print_trivial_report(report):
+    if report:
+        details = ", ".join(f"{kind} {count}" for kind, count in sorted(report.items()))
+        print(f"Skipped {sum(report.values())} trivial chunks without LLM review: {details}")
+
+
+#############################################
+# 运行指标与追踪
+#############################################
+# 服务模式下进程长期运行：每个阶段只保留这么多耗时样本（水库抽样）用于分位数，MR 摘要只保留最近这么多个
+METRICS_RESERVOIR_SIZE = 1024
+METRICS_MAX_MERGE_REQUESTS = 1000
+
+def percentile(sorted_samples, fraction):
+    """ 最近秩法取分位数（秩为 ceil(fraction * n)），sorted_samples 需已升序排列且非空 """
+    # 先舍去浮点误差，避免 0.07 * 100 = 7.000000000000001 被向上取整为 8
+    rank = math.ceil(round(fraction * len(sorted_samples), 9))
+    index = max(0, min(len(sorted_samples) - 1, rank - 1))
+    return sorted_samples[index]
+
+class StageStats:
+    """
+    单个阶段的耗时统计：次数、总耗时和最大值精确累计，分位数取自最多 METRICS_RESERVOIR_SIZE 个均匀抽样的样本，内存占用固定
+    """
+    __slots__ = ("count", "total", "max", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < METRICS_RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            # 水库抽样（Algorithm R）：第 count 个样本以 size / count 的概率替换一个已有样本
+            index = random.randrange(self.count)
+            if index < METRICS_RESERVOIR_SIZE:
+                self.samples[index] = seconds
+
+class RunMetrics:
+    """
+    整个进程的运行指标（线程安全）：各阶段每次执行的耗时和计数器，批量模式 / 服务模式下累计所有 MR。
+    阶段：fetch（GitLab 读请求）、parse、filter、prompt_build、llm_call（流式模式下到收到响应头为止）、
+    response_parse（流式模式下包含接收剩余回复）、publish，以及每个 MR 的 merge_request 总耗时。
+    设置 tracer（见 setup_tracing）后每个阶段同时作为 OpenTelemetry span 导出。
+    耗时样本和 MR 摘要都有上限，服务模式下长期运行时内存不会增长
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.durations = {}  # 阶段 -> StageStats
+        self.counters = {}
+        self.merge_requests = deque(maxlen=METRICS_MAX_MERGE_REQUESTS)
+        self.tracer = None
+
+    @contextlib.contextmanager
+    def span(self, stage, **attributes):
+        otel_span = self.tracer.start_as_current_span(stage, attributes=attributes) if self.tracer \
+            else contextlib.nullcontext()
+        start = time.perf_counter()
+        try:
+            with otel_span:
+                yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            stats = self.durations.get(stage)
+            if stats is None:
+                stats = self.durations[stage] = StageStats()
+            stats.add(seconds)
+
+    def incr(self, name, value=1):
+        if value:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def bind(self, fn):
+        """
+        线程池不会传递 contextvars，开启追踪时用提交任务时的上下文运行 fn，worker 线程中的 span 挂在当前 span 下
+        """
+        if self.tracer is None:
+            return fn
+        return functools.partial(contextvars.copy_context().run, fn)
+
+    def record_merge_request(self, summary):
+        with self._lock:
+            self.merge_requests.append(summary)
+
+    def report(self):
+        with self._lock:
+            durations = {stage: (stats.count, stats.total, stats.max, sorted(stats.samples))
+                         for stage, stats in self.durations.items()}
+            counters = dict(sorted(self.counters.items()))
+            merge_requests = list(self.merge_requests)
+        stages = {
+            stage: {
+                "count": count,
+                "total_ms": round(total * 1000, 3),
+                "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+                "max_ms": round(maximum * 1000, 3),
+            }
+            for stage, (count, total, maximum, samples) in sorted(durations.items())
+        }
+        return {
+            "started_at": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(),
+            "wall_s": round(time.time() - self.started, 3),
+            "model": OPENAI_API_MODEL,
+            "prompt_version": PROMPT_VERSION,
+            "stages": stages,
+            "counters": counters,
+            "merge_requests": merge_requests,
+        }
+
+    def openmetrics(self):
+        """ 以 OpenMetrics 文本格式导出：阶段耗时为 summary，计数器为 counter """
+        report = self.report()
+        lines = ["# TYPE ai_review_stage_seconds summary",
+                 "# UNIT ai_review_stage_seconds seconds",
+                 "# HELP ai_review_stage_seconds Duration of review pipeline stages."]
+        for stage, stats in report["stages"].items():
+            for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+                value = round(stats[key] / 1000, 6)
+                lines.append(f'ai_review_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value}')
+            lines.append(f'ai_review_stage_seconds_sum{{stage="{stage}"}} {round(stats["total_ms"] / 1000, 6)}')
+            lines.append(f'ai_review_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        for name, value in report["counters"].items():
+            metric = "ai_review_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}_total {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+metrics = RunMetrics()
+
+def setup_tracing(endpoint=None):
+    """
+    配置了 OTLP endpoint 时创建 OpenTelemetry tracer 并挂到 metrics 上，返回 TracerProvider（退出前需 shutdown 以发送剩余 span）；
+    未配置或未安装 opentelemetry-sdk / OTLP exporter 时返回 None，只记录本地指标
+    """
+    endpoint = OTLP_ENDPOINT if endpoint is None else endpoint
+    if not endpoint:
+        return None
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        print("OpenTelemetry SDK or OTLP exporter is not installed, tracing disabled:", e)
+        return None
+    provider = TracerProvider(resource=Resource.create({"service.name": "ai-code-review"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    metrics.tracer = provider.get_tracer("ai-code-review")
+    return provider
+
+def write_run_report(report_path=None, openmetrics_path=None):
+    """
+    按 INPUT_METRICS_REPORT / INPUT_METRICS_OPENMETRICS 写出 JSON 运行报告和 OpenMetrics 文本，写入失败只打印错误
+    """
+    report_path = METRICS_REPORT_PATH if report_path is None else report_path
+    openmetrics_path = METRICS_OPENMETRICS_PATH if openmetrics_path is None else openmetrics_path
+    try:
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(metrics.report(), f, ensure_ascii=False, indent=2)
+            print(f"Wrote run report to {report_path}")
+        if openmetrics_path:
+            with open(openmetrics_path, "w", encoding="utf-8") as f:
+                f.write(metrics.openmetrics())
+            print(f"Wrote OpenMetrics to {openmetrics_path}")
+    except OSError as e:
+        print("Error writing run report:", e)
+
+
+#############################################
+# 录制与回放
+#############################################
+CASSETTE_MODES = ("off", "record", "replay")
+# 回放 GitLab 响应时保留的响应头（JSON 解析和分页需要）
+CASSETTE_HEADERS = ("content-type", "link", "x-next-page", "x-page", "x-per-page", "x-total", "x-total-pages")
+
+class CassetteMissError(Exception):
+    """ 回放模式下 cassette 中没有该请求的录制结果 """
+
+class Cassette:
+    """
+    GitLab HTTP 请求和 chat.completions.create 调用的录制 / 回放层。
+    每个请求按内容寻址：key 为方法、去掉域名的 URL、排序后的查询参数和请求体（LLM 为除 timeout 外的全部参数）的哈希，
+    响应以 gzip 压缩的 JSON 保存为 <dir>/<key 前两位>/<key>.json.gz，相同的请求只保存一份。
+    限流（429）、5xx 和网络错误不录制（由重试处理），其余错误响应（如 404、结构化输出被拒绝的 400）照常录制和回放
+    """
+    def __init__(self, directory, mode):
+        self.directory = directory
+        self.mode = mode
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+
+    def load(self, key, description):
+        try:
+            with gzip.open(self.path(key), "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            metrics.incr("cassette_misses")
+            raise CassetteMissError(f"No recorded response for {description} in {self.directory}") from None
+        metrics.incr("cassette_replays")
+        return entry
+
+    def save(self, key, entry):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再原子替换，多个线程录制同一个请求时不会留下半个文件
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(temp, "wt", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(temp, path)
+        metrics.incr("cassette_records")
+
+    def gitlab_request(self, request, method, url, *args, **kwargs):
+        parts = urllib.parse.urlsplit(url)
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        query += [(str(name), str(value)) for name, value in (kwargs.get("params") or {}).items() if value is not None]
+        target = parts.path + ("?" + urllib.parse.urlencode(sorted(query)) if query else "")
+        key = self.key("gitlab", method.upper(), target, kwargs.get("json"), kwargs.get("data"))
+        if self.mode == "replay":
+            entry = self.load(key, f"{method.upper()} {target}")
+            response = requests.models.Response()
+            response.status_code = entry["status"]
+            response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+            response._content = base64.b64decode(entry["body_b64"]) if "body_b64" in entry else entry["body"].encode()
+            response.encoding = "utf-8"
+            response.url = url
+            return response
+        response = request(method, url, *args, **kwargs)
+        if response.status_code != 429 and response.status_code < 500:
+            entry = {"request": f"{method.upper()} {target}", "status": response.status_code,
+                     "headers": {name: value for name, value in response.headers.items()
+                                 if name.lower() in CASSETTE_HEADERS}}
+            try:
+                entry["body"] = response.content.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["body_b64"] = base64.b64encode(response.content).decode()
+            self.save(key, entry)
+        return response
+
+    def chat_completion(self, create, params):
+        """ create 为实际调用 chat.completions.create 的函数，回放模式下不会被调用（也不会创建 OpenAI 客户端） """
+        key = self.key("llm", {name: value for name, value in params.items() if name != "timeout"})
+        if self.mode == "replay":
+            entry = self.load(key, f"chat completion ({len(params.get('messages', []))} messages)")
+            if "error" in entry:
+                raise self.api_error(entry["error"])
+            # 回放时用轻量的属性对象代替 SDK 的响应模型，不需要导入 openai
+            if "stream" in entry:
+                return iter([replay_object(event) for event in entry["stream"]])
+            return replay_object(entry["response"])
+        request = {"model": params.get("model"), "messages": len(params.get("messages", []))}
+        try:
+            response = create()
+        except openai.APIStatusError as e:
+            if not is_retryable(e):
+                self.save(key, {"request": request, "error": {"status": e.status_code, "message": e.message,
+                                                              "body": e.body}})
+            raise
+        if params.get("stream"):
+            return self._record_stream(key, request, response)
+        self.save(key, {"request": request, "response": response.model_dump(mode="json", exclude_unset=True)})
+        return response
+
+    def _record_stream(self, key, request, stream):
+        # 边转发边记录流式事件，流完整结束后才保存
+        events = []
+        for event in stream:
+            events.append(event.model_dump(mode="json", exclude_unset=True))
+            yield event
+        self.save(key, {"request": request, "stream": events})
+
+    @staticmethod
+    def api_error(error):
+        import httpx
+        response = httpx.Response(error["status"], json=error["body"],
+                                  request=httpx.Request("POST", f"{OPENAI_API_URL or ''}/chat/completions"))
+        error_class = {400: openai.BadRequestError, 422: openai.UnprocessableEntityError}.get(
+            error["status"], openai.APIStatusError)
+        return error_class(error["message"], response=response, body=error["body"])
+
+class ReplayObject:
+    """ 以属性方式访问录制的响应字段，录制时未设置的字段为 None（与 SDK 响应模型的默认值一致） """
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    def __getattr__(self, name):
+        return None
+
+def replay_object(value):
+    if isinstance(value, dict):
+        return ReplayObject({name: replay_object(item) for name, item in value.items()})
+    if isinstance(value, list):
+        return [replay_object(item) for item in value]
+    return value
+
+cassette = Cassette(CASSETTE_DIR, CASSETTE_MODE) if CASSETTE_MODE in ("record", "replay") else None
+
+
+#############################################
+# 限流、重试与熔断
+#############################################
+class CircuitOpenError(Exception):
+    """ 熔断器打开期间拒绝请求 """
+
+class TokenBucket:
+    """
+    令牌桶：每分钟补充 rate_per_min 个令牌，最多积攒一分钟的量；acquire 在令牌不足时阻塞等待
+    """
+    def __init__(self, rate_per_min):
+        self.capacity = float(rate_per_min)
+        self.tokens = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        amount = min(float(amount), self.capacity)  # 单次请求超过桶容量时按满桶处理，避免永久阻塞
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后打开，reset_seconds 内调用方阻塞等待；
+    之后进入半开状态只放行一个探测请求，成功则关闭并唤醒等待者，失败则重新打开
+    """
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probe = None  # 半开状态下正在探测的线程
+        self._cond = threading.Condition()
+
+    def before_call(self, deadline=None):
+        """
+        熔断打开时阻塞到可以探测；传入 deadline 且等不到截止前时抛出 CircuitOpenError
+        """
+        with self._cond:
+            while self.opened_at is not None:
+                wait = self.opened_at + self.reset_seconds - time.monotonic()
+                if wait <= 0 and self.probe is None:
+                    self.probe = threading.get_ident()
+                    return
+                if deadline is not None and deadline.remaining() <= max(wait, 0):
+                    raise CircuitOpenError("circuit open after %d consecutive failures" % self.failures)
+                # 探测进行中时等它 record 后唤醒
+                if wait <= 0:
+                    wait = deadline.remaining() if deadline is not None else None
+                self._cond.wait(wait)
+
+    def available(self):
+        """ 是否可以立即放行：未熔断，或已到半开且没有探测在进行 """
+        with self._cond:
+            return self.opened_at is None or (
+                time.monotonic() - self.opened_at >= self.reset_seconds and self.probe is None)
+
+    def record(self, success):
+        """
+        success 为 None 表示本次结果与 endpoint 健康无关（如 429 限流），不影响熔断计数，只结束探测
+        """
+        with self._cond:
+            if self.probe == threading.get_ident():
+                self.probe = None
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            elif success is not None:
+                self.failures += 1
+                if self.failure_threshold and self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+            self._cond.notify_all()
+
+def retry_after_seconds(error):
+    """
+    从 OpenAI SDK / requests 异常携带的响应头中读取 Retry-After（秒），没有时返回 None；
+    python-gitlab 的 429 异常不带响应，读取本线程最近一次 GitLab 429 响应的 Retry-After
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if response is None and getattr(error, "response_code", None) == 429:
+        value = getattr(_gitlab_throttle, "retry_after", None)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def error_status(error):
+    return getattr(error, "status_code", None) or getattr(error, "response_code", None)
+
+def is_retryable(error):
+    """
+    限流（429）、服务端错误（5xx）、超时和连接错误可以重试，其余错误直接失败
+    """
+    # SDK 尚未导入时不可能抛出它的异常，不为判断异常类型而导入
+    if requests.loaded and isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if openai.loaded and isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status = error_status(error)
+    return status == 429 or (status is not None and status >= 500)
+
+class RateLimitScheduler:
+    """
+    单个 endpoint 的共享调度器：请求数 / token 数令牌桶限流，可重试错误按 Retry-After 或带抖动的指数退避重试，
+    连续的 5xx / 超时 / 连接错误触发熔断，所有 worker 线程共用同一个实例。
+    admit / record 可单独使用（LLM 后端池中每个后端各自限流和熔断，重试由外层调度器负责）；breaker_failures 为 0 时不熔断
+    """
+    def __init__(self, name, requests_per_min=0, tokens_per_min=0, max_retries=MAX_RETRIES,
+                 base_delay=1.0, max_delay=60.0, breaker_failures=BREAKER_FAILURES):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_min) if requests_per_min > 0 else None
+        self.token_bucket = TokenBucket(tokens_per_min) if tokens_per_min > 0 else None
+        self.breaker = CircuitBreaker(breaker_failures, BREAKER_RESET_SECONDS)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+
+    def admit(self, tokens=0, deadline=None):
+        """ 等待熔断器放行并从令牌桶取得请求数 / token 数配额，之后必须调用 record """
+        self.breaker.before_call(deadline)
+        try:
+            if self.request_bucket:
+                self.request_bucket.acquire()
+            if self.token_bucket and tokens:
+                self.token_bucket.acquire(tokens)
+        except BaseException:
+            self.breaker.record(None)
+            raise
+
+    def record(self, error=None):
+        """
+        按请求结果更新熔断器。429 只是被限流，交给 Retry-After 和令牌桶处理；不可重试的错误（如 400）说明 endpoint 本身可用；
+        两者都不计入熔断
+        """
+        if error is None:
+            self.breaker.record(True)
+        elif isinstance(error, Exception):
+            self.breaker.record(None if error_status(error) == 429 else not is_retryable(error))
+        else:
+            self.breaker.record(None)
+
+    def call(self, fn, tokens=0, deadline=None, idempotent=True):
+        """
+        执行 fn 并按需限流、重试；传入 deadline（时间预算）时，剩余时间不足以等待下一次重试就不再重试，
+        fn 每次执行时应按 deadline.request_timeout() 设置本次请求的超时。
+        idempotent 为 False 的写请求（如创建评论）只在 429 时重试：超时、连接错误和 5xx 时请求可能已经生效，重试会重复写入
+        """
+        attempt = 0
+        while True:
+            self.admit(tokens, deadline)
+            try:
+                result = fn()
+            except Exception as e:
+                retryable = is_retryable(e) if idempotent else error_status(e) == 429
+                self.record(e)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    # full jitter 指数退避
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if deadline is not None and deadline.remaining() <= delay:
+                    raise
+                attempt += 1
+                self.retries += 1
+                metrics.incr(f"{self.name}_retries")
+                print(f"{self.name}: retry {attempt}/{self.max_retries} in {delay:.1f}s after error: {e}")
+                time.sleep(delay)
+                continue
+            except BaseException as e:
+                self.record(e)
+                raise
+            self.record()
+            return result
+
+# 回放模式不访问真实 endpoint，不限流
+_replaying = CASSETTE_MODE == "replay"
+# LLM 请求的限流和熔断按后端分别进行（见 LLMBackend.limiter），这里只负责重试，重试时后端池会重新选择后端
+llm_scheduler = RateLimitScheduler("llm", breaker_failures=0)
+gitlab_scheduler = RateLimitScheduler("gitlab", 0 if _replaying else GITLAB_REQUESTS_PER_MIN)
+
+
+#############################################
+# 多 endpoint 负载均衡与对冲请求
+#############################################
+# 计算 p95 所需的最少延迟样本数，样本不足时不发对冲请求
+HEDGE_MIN_SAMPLES = 20
+# 延迟 / 错误率滑动平均的平滑系数
+EWMA_ALPHA = 0.2
+
+class LLMBackend:
+    """
+    一个 OpenAI 兼容的后端：权重、在途请求数，以及近期延迟（滑动窗口和 EWMA）和错误率（EWMA）。
+    只有可重试错误（429 / 5xx / 超时 / 连接错误）计入错误率，400 等请求本身的问题不说明后端不健康。
+    每个后端有自己的限流器和熔断器（limiter），一个后端连续出错只熔断它自己
+    """
+    def __init__(self, name, url, model, api_key, weight=1.0, tier="large",
+                 requests_per_min=LLM_REQUESTS_PER_MIN, tokens_per_min=LLM_TOKENS_PER_MIN):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.weight = weight
+        self.tier = tier
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.latency = None  # EWMA，秒
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=200)
+        self.limiter = RateLimitScheduler(f"llm_{name}", 0 if _replaying else requests_per_min,
+                                          0 if _replaying else tokens_per_min)
+
+    @property
+    def client(self):
+        # 重试统一交给 llm_scheduler，关闭 SDK 自带的重试
+        return _shared_client(f"openai:{self.name}", lambda: openai.OpenAI(
+            base_url=self.url,
+            api_key=self.api_key,
+            max_retries=0
+        ))
+
+    def cost(self, default_latency):
+        # 预计完成时间：按权重折算的排队请求数 x 平均延迟，错误率越高越不优先
+        return (self.in_flight + 1) / self.weight * (self.latency or default_latency) / max(0.05, 1 - self.error_rate)
+
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(LLM_HEDGE_MIN_DELAY, percentile(sorted(self.latencies), 0.95))
+
+def load_llm_backends(spec=None):
+    """
+    解析 INPUT_LLM_BACKENDS 为 LLMBackend 列表，为空时返回只含 OPENAI_API_URL 的单个后端；配置错误时抛出 ValueError
+    """
+    spec = LLM_BACKENDS if spec is None else spec
+    if not spec:
+        return [LLMBackend("default", OPENAI_API_URL, OPENAI_API_MODEL, OPENAI_API_KEY)]
+    try:
+        entries = json.loads(spec)
+    except ValueError as e:
+        raise ValueError(f"INPUT_LLM_BACKENDS is not valid JSON: {e}") from None
+    if not isinstance(entries, list) or not entries or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError("INPUT_LLM_BACKENDS must be a non-empty JSON list of objects")
+    backends = []
+    for index, entry in enumerate(entries):
+        tier = entry.get("tier", "large")
+        backend = LLMBackend(
+            str(entry.get("name") or index), entry.get("url") or OPENAI_API_URL,
+            entry.get("model") or (CASCADE_SMALL_MODEL if tier == "small" else OPENAI_API_MODEL),
+            entry.get("api_key") or OPENAI_API_KEY, float(entry.get("weight", 1)), tier,
+            int(entry.get("rpm", LLM_REQUESTS_PER_MIN)), int(entry.get("tpm", LLM_TOKENS_PER_MIN))
+        )
+        if tier not in MODEL_TIERS:
+            raise ValueError(f"LLM backend {backend.name} has tier {tier!r}, expected one of {', '.join(MODEL_TIERS)}")
+        for field, value in (("url", backend.url), ("api_key", backend.api_key), ("model", backend.model)):
+            if not value:
+                raise ValueError(f"LLM backend {backend.name} has no {field}")
+        if backend.weight <= 0:
+            raise ValueError(f"LLM backend {backend.name} must have a positive weight")
+        backends.append(backend)
+    if len({backend.name for backend in backends}) != len(backends):
+        raise ValueError("LLM backend names in INPUT_LLM_BACKENDS must be unique")
+    if not any(backend.tier == "large" for backend in backends):
+        raise ValueError("INPUT_LLM_BACKENDS needs at least one large tier backend")
+    if any(backend.tier == "small" for backend in backends) and not CASCADE_SMALL_MODEL:
+        raise ValueError("Small tier backends in INPUT_LLM_BACKENDS need INPUT_SMALL_MODEL to enable the model cascade")
+    return backends
+
+class LLMPool:
+    """
+    chat.completions.create 的后端池：每次请求发给预计完成时间最短的后端（least-loaded，按权重和近期延迟、错误率折算），
+    单次请求的重试仍由 llm_scheduler 负责，重试时会重新选择后端，自然避开刚出错的后端；熔断中的后端不参与选择
+    （全部熔断时等待熔断结束）。每个请求（包括对冲请求）都计入所发往后端的限流器。
+    请求只发给对应模型分级（tier）的后端；没有配置小模型后端时，小模型请求发给大模型后端并指定小模型名
+    （同一个 endpoint 提供多个模型的情况，如 OpenAI 官方 API）。
+    hedge 时请求超过所选后端延迟的 p95 仍未返回，则向另一个后端发送相同的请求，采用先成功返回的结果，
+    另一个请求的结果被丢弃（流式响应会被关闭）
+    """
+    def __init__(self, backends, hedge=False):
+        self.backends = backends
+        self.hedge = hedge
+        self._lock = threading.Lock()
+
+    @property
+    def limits_tokens(self):
+        return any(backend.limiter.token_bucket for backend in self.backends)
+
+    def candidates(self, tier):
+        """ 返回 (可用后端列表, 需要覆盖的模型名)，后端自带模型时模型名为 None """
+        backends = [backend for backend in self.backends if backend.tier == tier]
+        if backends:
+            return backends, None
+        return [backend for backend in self.backends if backend.tier == "large"], CASCADE_SMALL_MODEL
+
+    def acquire(self, backends, exclude=None):
+        with self._lock:
+            candidates = [backend for backend in backends if backend is not exclude]
+            candidates = [backend for backend in candidates if backend.limiter.breaker.available()] or candidates
+            known = [backend.latency for backend in candidates if backend.latency is not None]
+            default_latency = sum(known) / len(known) if known else 1.0
+            backend = min(candidates, key=lambda b: b.cost(default_latency))
+            backend.in_flight += 1
+            return backend
+
+    def release(self, backend, elapsed, failed):
+        with self._lock:
+            backend.in_flight -= 1
+            backend.calls += 1
+            backend.error_rate += EWMA_ALPHA * (float(failed) - backend.error_rate)
+            if failed:
+                backend.errors += 1
+            else:
+                backend.latencies.append(elapsed)
+                backend.latency = elapsed if backend.latency is None else \
+                    backend.latency + EWMA_ALPHA * (elapsed - backend.latency)
+
+    def call(self, backend, params, model=None, tokens=0, deadline=None):
+        """
+        在已 acquire 的后端上发送请求（model 默认为该后端的模型），先经该后端的限流器和熔断器放行；
+        流式请求的延迟为收到响应头的时间
+        """
+        try:
+            backend.limiter.admit(tokens, deadline)
+        except BaseException:
+            with self._lock:
+                backend.in_flight -= 1
+            raise
+        start = time.perf_counter()
+        metrics.incr(f"llm_requests_{backend.name}")
+        try:
+            response = backend.client.chat.completions.create(**params, model=model or backend.model)
+        except BaseException as e:
+            backend.limiter.record(e)
+            self.release(backend, time.perf_counter() - start, isinstance(e, Exception) and is_retryable(e))
+            raise
+        backend.limiter.record()
+        self.release(backend, time.perf_counter() - start, False)
+        return response
+
+    def create(self, tier="large", tokens=0, deadline=None, **params):
+        """ tokens 为本次请求计入 token 限流的数量，deadline 为时间预算（后端熔断时最多等到截止） """
+        params.pop("model", None)
+        backends, model = self.candidates(tier)
+        backend = self.acquire(backends)
+        delay = backend.hedge_delay() if self.hedge and len(backends) > 1 else None
+        if delay is None:
+            return self.call(backend, params, model, tokens, deadline)
+        primary = self._start(backend, params, model, tokens, deadline)
+        done, _ = wait([primary], timeout=delay)
+        if done or not any(b is not backend and b.limiter.breaker.available() for b in backends):
+            return primary.result()  # 没有可用的其他后端时不对冲
+        # 对冲请求计入第二个后端自己的限流器
+        secondary = self._start(self.acquire(backends, exclude=backend), params, model, tokens, deadline)
+        metrics.incr("llm_hedged_requests")
+        pending = [primary, secondary]
+        while pending:
+            done, rest = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is secondary:
+                        metrics.incr("llm_hedge_wins")
+                    for other in rest:
+                        other.add_done_callback(self._discard)
+                    return future.result()
+            pending = list(rest)
+        raise primary.exception()
+
+    def _start(self, backend, params, model, tokens=0, deadline=None):
+        # 对冲时每个请求在独立的线程中发送，调用方只等待先返回的那个
+        future = Future()
+        call = metrics.bind(self.call)
+
+        def run():
+            try:
+                future.set_result(call(backend, params, model, tokens, deadline))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, name=f"llm-{backend.name}", daemon=True).start()
+        return future
+
+    @staticmethod
+    def _discard(future):
+        # 对冲中落败的流式响应不会被读取，关闭以释放连接
+        if future.exception() is None and hasattr(future.result(), "close"):
+            future.result().close()
+
+    def report(self):
+        with self._lock:
+            return {
+                backend.name: {
+                    "tier": backend.tier, "calls": backend.calls, "errors": backend.errors, "in_flight": backend.in_flight,
+                    "latency_ewma_s": round(backend.latency, 3) if backend.latency is not None else None,
+                    "p95_s": round(percentile(sorted(backend.latencies), 0.95), 3) if backend.latencies else None,
+                }
+                for backend in self.backends
+            }
+
+def print_backend_report():
+    # 只有配置了多个后端时才打印
+    if "llm_pool" in _clients and len(_clients["llm_pool"].backends) > 1:
+        for name, stats in _clients["llm_pool"].report().items():
+            print(f"LLM backend {name} ({stats['tier']}): {stats['calls']} calls, {stats['errors']} errors, "
+                  f"p95 {stats['p95_s']} s, in flight {stats['in_flight']}")
+
+
+#############################################
+# token 计数与代码块打包
+#############################################
+_tokenizer = None
+
+def count_tokens(text):
+    """
+    用本地 tokenizer（tiktoken）计算文本的 token 数，tiktoken 不可用时按 4 字符/token 估算
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        try:
+            import tiktoken
+            try:
+                _tokenizer = tiktoken.encoding_for_model(OPENAI_API_MODEL)
+            except KeyError:
+                _tokenizer = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print("tiktoken unavailable, estimating token counts:", e)
+            _tokenizer = False
+    if _tokenizer is False:
+        return len(text) // 4 + 1
+    return len(_tokenizer.encode(text, disallowed_special=()))
+
+@functools.lru_cache(maxsize=64)
+def count_prefix_tokens(text):
+    """
+    共享前缀（system prompt、MR 上下文）在每次请求中都相同，缓存其 token 数
+    """
+    return count_tokens(text)
+
+def count_messages_tokens(messages):
+    return sum(count_tokens(m["content"]) for m in messages)
+
+class LLMUsage:
+    """
+    LLM 调用的累计用量（线程安全）：调用次数、prompt / completion token、provider 报告的缓存命中 token，
+    以及每次请求中共享前缀的 token 数
+    """
+    FIELDS = ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "prefix_tokens")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def record_response(self, usage, prefix_tokens=0):
+        details = getattr(usage, "prompt_tokens_details", None)
+        with self._lock:
+            self.counts["calls"] += 1
+            self.counts["prefix_tokens"] += prefix_tokens
+            self.counts["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            self.counts["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+            self.counts["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+        metrics.incr("llm_calls")
+        metrics.incr("prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+        metrics.incr("completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+        metrics.incr("cached_prompt_tokens", getattr(details, "cached_tokens", 0) or 0)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def since(self, snapshot):
+        current = self.snapshot()
+        return {key: current[key] - snapshot.get(key, 0) for key in self.FIELDS}
+
+# 没有 MR 上下文的调用记入全局用量
+llm_usage = LLMUsage()
+
+def pack_chunks(items, token_budget):
+    """
+    按 token 预算将 (file, chunk) 列表装箱（first-fit decreasing），每个箱子对应一次 LLM 调用；
+    超过预算的代码块单独成箱。箱内保持原始顺序，返回的箱子按首个代码块的位置排序
+    """
+    sizes = [count_tokens(format_chunk(chunk)) for _, chunk in items]
+    bins = []  # 每项为 [剩余预算, 下标列表]
+    for index in sorted(range(len(items)), key=lambda i: sizes[i], reverse=True):
+        for packed in bins:
+            if sizes[index] <= packed[0]:
+                packed[0] -= sizes[index]
+                packed[1].append(index)
+                break
+        else:
+            bins.append([token_budget - sizes[index], [index]])
+    groups = sorted(sorted(indexes) for _, indexes in bins)
+    return [[items[i] for i in indexes] for indexes in groups]
+
+def split_chunk(chunk, max_tokens, overlap_lines):
+    """
+    将超过 token 上限的代码块按行切分为多个窗口，相邻窗口重叠 overlap_lines 行作为上下文；
+    每个窗口保留原始的 DiffChange（old_line/new_line 不变），hunk 头沿用原代码块的。
+    重叠行只作上下文（owned_from），评论只落在每个窗口自己负责的行上，同一行不会被评论两次
+    """
+    header = chunk.header
+    line_tokens = [count_tokens(c.content) + count_tokens(format_change(c)) for c in chunk.changes]
+    budget = max_tokens - count_tokens(header)
+    windows = []
+    start = covered = 0  # covered：之前的窗口已负责到的位置
+    while covered < len(chunk.changes):
+        end = start
+        used = 0
+        while end < len(chunk.changes) and (end == start or used + line_tokens[end] <= budget):
+            used += line_tokens[end]
+            end += 1
+        if end <= covered:
+            # 重叠的上下文占满了预算（下一行过长），不带重叠从未负责的行开始
+            start = covered
+            continue
+        windows.append(DiffChunk(header, chunk.changes[start:end], covered - start))
+        covered = end
+        start = max(start + 1, end - overlap_lines)
+    return windows
+
+def budget_file(file, report, max_chunk_tokens=None, max_file_tokens=None, overlap_lines=None):
+    """
+    对单个文件做 token 预算：超过 max_file_tokens 的文件整体跳过（返回 None），超过 max_chunk_tokens 的代码块切分为重叠窗口。
+    结果记入 report：split 为 [(文件, 原代码块下标, 窗口数)]，skipped 为 [(文件, token 数)]
+    """
+    max_chunk_tokens = REVIEW_MAX_CHUNK_TOKENS if max_chunk_tokens is None else max_chunk_tokens
+    max_file_tokens = REVIEW_MAX_FILE_TOKENS if max_file_tokens is None else max_file_tokens
+    overlap_lines = REVIEW_CHUNK_OVERLAP_LINES if overlap_lines is None else overlap_lines
+    chunk_tokens = [count_tokens(format_chunk(chunk)) for chunk in file.chunks]
+    if max_file_tokens and sum(chunk_tokens) > max_file_tokens:
+        report["skipped"].append((file.to, sum(chunk_tokens)))
+        metrics.incr("files_over_token_budget")
+        return None
+    chunks = []
+    for index, (chunk, tokens) in enumerate(zip(file.chunks, chunk_tokens)):
+        if max_chunk_tokens and tokens > max_chunk_tokens:
+            windows = split_chunk(chunk, max_chunk_tokens, overlap_lines)
+            report["split"].append((file.to, index, len(windows)))
+            metrics.incr("hunks_split")
+            chunks.extend(windows)
+        else:
+            chunks.append(chunk)
+    return DiffFile(file.to, chunks)
+
+def report_diff_completeness(pr_details):
+    """
+    打印 MR 是否过大导致无法完整 review
+    """
+    session = pr_details.get("session")
+    if session is None:
+        return
+    report = session.diff_report
+    if report["overflow"]:
+        print("WARNING: GitLab truncated the MR changes (overflow), the review is incomplete; "
+              "use INPUT_DIFF_MODE=paginated for a complete review")
+    if report["unreviewed"]:
+        print(f"WARNING: MR too big for a complete review, {len(report['unreviewed'])} files without diff: "
+              + ", ".join(report["unreviewed"]))
+
+def print_budget_report(report):
+    for path, index, count in report["split"]:
+        print(f"Split oversized chunk #{index} of {path} into {count} windows")
+    for path, tokens in report["skipped"]:
+        print(f"Skipped {path}: {tokens} tokens exceeds INPUT_MAX_FILE_TOKENS")
+
+
+#############################################
+# 时间预算与风险优先级
+#############################################
+class Deadline:
+    """
+    review 的时间预算：remaining() 为距离截止的秒数；
+    can_start() 在预算只剩 reserve 秒（用于在途请求收尾和发布总结）之前为 True；
+    request_timeout() 为 LLM 请求的超时，在途请求最多用掉 reserve 的一半，另一半留给发布总结
+    """
+    def __init__(self, seconds, reserve=TIME_BUDGET_RESERVE):
+        self.expires = time.monotonic() + seconds
+        self.reserve = min(reserve, seconds / 2)
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    def can_start(self):
+        return self.remaining() > self.reserve
+
+    def request_timeout(self):
+        return max(1.0, self.remaining() - self.reserve / 2)
+
+# 被时间预算跳过的代码块在结果中的占位
+SKIPPED = object()
+
+LANGUAGE_WEIGHTS = {
+    ".py": 1.0, ".go": 1.0, ".java": 1.0, ".kt": 1.0, ".scala": 1.0, ".js": 1.0, ".ts": 1.0, ".tsx": 1.0,
+    ".jsx": 1.0, ".c": 1.0, ".cc": 1.0, ".cpp": 1.0, ".h": 1.0, ".hpp": 1.0, ".rs": 1.0, ".rb": 1.0,
+    ".php": 1.0, ".cs": 1.0, ".swift": 1.0, ".sql": 1.0, ".sh": 0.8,
+    ".yml": 0.5, ".yaml": 0.5, ".json": 0.4, ".toml": 0.5, ".ini": 0.5, ".xml": 0.4,
+    ".md": 0.2, ".rst": 0.2, ".txt": 0.2,
+}
+HIGH_RISK_PATH = re.compile(
+    r"auth|security|crypto|passw|secret|token|permission|payment|billing|migration|concurren|lock|transaction",
+    re.IGNORECASE)
+LOW_RISK_PATH = re.compile(
+    r"(^|/)(vendor|third_party|node_modules|docs?|examples?|fixtures?|tests?)/|generated|\.min\.|_test\.|test_",
+    re.IGNORECASE)
+FUNCTION_DEF = re.compile(r"\b(def|func|function|fn|class|interface|struct)\s+\w+")
+
+def risk_score(file, chunk):
+    """
+    代码块的风险分：改动行数（churn）和涉及的函数/类定义数，乘以语言权重和路径权重（敏感路径加权、
+    vendor/测试/文档降权），分数越高越先 review
+    """
+    churn = 0
+    functions = 1 if chunk.header else 0
+    for c in chunk.changes:
+        if c.ln is None or c.ln2 is None:
+            churn += 1
+            if FUNCTION_DEF.search(c.content):
+                functions += 1
+    path = file.to or ""
+    weight = LANGUAGE_WEIGHTS.get(os.path.splitext(path)[1].lower(), 0.6)
+    if HIGH_RISK_PATH.search(path):
+        weight *= 2
+    if LOW_RISK_PATH.search(path):
+        weight *= 0.3
+    return (churn + 5 * functions) * weight
+
+def chunk_label(file, chunk):
+    lines = [c.ln for c in chunk.changes if c.ln is not None] or [c.ln2 for c in chunk.changes if c.ln2 is not None]
+    return f"{file.to}:{min(lines)}-{max(lines)}" if lines else file.to
+
+
+#############################################
+# 模型分级路由
+#############################################
+MODEL_TIERS = ("small", "large")
+# 分支 / 循环 / 异常处理 / 短路运算，用于估算改动的圈复杂度
+DECISION_POINT = re.compile(r"\b(if|elif|for|foreach|while|case|catch|except|switch|select|match|when)\b|&&|\|\||\?\?")
+# 并发、安全、数据访问相关的代码，小模型容易漏看
+SENSITIVE_CODE = re.compile(
+    r"\b(lock|mutex|semaphore|atomic|volatile|synchronized|thread\w*|async|await|goroutine|chan|unsafe|eval|exec|"
+    r"subprocess|pickle|deserializ\w*|sql|cursor|password|secret|token|crypt\w*|signature|permission|auth\w*)\b",
+    re.IGNORECASE)
+PYTHON_DECISION_NODES = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.Try, ast.ExceptHandler, ast.With,
+                         ast.AsyncWith, ast.BoolOp, ast.IfExp, ast.comprehension, ast.Assert)
+PYTHON_FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+
+def _python_complexity(lines):
+    """
+    新增的 Python 代码能单独解析时按 AST 统计 (分支节点数, 函数/类定义数)，否则返回 None 改用正则估算
+    """
+    try:
+        tree = ast.parse(textwrap.dedent("\n".join(lines)))
+    except (SyntaxError, ValueError):
+        return None
+    decisions = functions = 0
+    for node in ast.walk(tree):
+        if isinstance(node, PYTHON_DECISION_NODES):
+            decisions += 1
+        elif isinstance(node, PYTHON_FUNCTION_NODES):
+            functions += 1
+    return decisions, functions
+
+def complexity_score(file, chunk):
+    """
+    代码块的复杂度分：改动行数乘以语言权重，加上改动中的分支数（Python 按 AST，其余按关键字估算）、
+    函数/类定义数和并发/安全相关代码的行数；vendor/测试/文档等路径降权
+    """
+    path = file.to or ""
+    changed = [c.content for c in chunk.changes if c.ln is None or c.ln2 is None]
+    added = [c.content for c in chunk.changes if c.ln is not None and c.ln2 is None]
+    counts = _python_complexity(added) if path.endswith(".py") and added else None
+    if counts is None:
+        decisions = sum(len(DECISION_POINT.findall(line)) for line in changed)
+        functions = sum(1 for line in changed if FUNCTION_DEF.search(line))
+    else:
+        decisions, functions = counts
+    sensitive = sum(1 for line in changed if SENSITIVE_CODE.search(line))
+    score = len(changed) * LANGUAGE_WEIGHTS.get(os.path.splitext(path)[1].lower(), 0.6)
+    score += 3 * decisions + 5 * functions + 5 * sensitive
+    if LOW_RISK_PATH.search(path):
+        score *= 0.3
+    return score
+
+def route_tier(file, chunk):
+    """
+    代码块应使用的模型分级：未设置 INPUT_SMALL_MODEL 时总是 large；敏感路径或复杂度分数达到 INPUT_CASCADE_THRESHOLD 时为 large
+    """
+    if not CASCADE_SMALL_MODEL:
+        return "large"
+    if HIGH_RISK_PATH.search(file.to or "") or complexity_score(file, chunk) >= CASCADE_THRESHOLD:
+        return "large"
+    return "small"
+
+def tier_model(tier):
+    return CASCADE_SMALL_MODEL if tier == "small" and CASCADE_SMALL_MODEL else OPENAI_API_MODEL
+
+CONFIDENCE = re.compile(r'"confidence"\s*:\s*"?(\d+(?:\.\d+)?)')
+
+def response_confidence(text):
+    """ 回复中的 confidence（0~1，按百分比给出时换算），没有给出时返回 None """
+    match = CONFIDENCE.search(text)
+    if not match:
+        return None
+    value = float(match.group(1))
+    return value / 100 if value > 1 else value
 
 
 #############################################
 # 调用 OpenAI 接口及生成 review 评论相关函数
 #############################################
-def create_prompt(file, chunk, pr_details):
+def change_action(c):
+    """
+    根据新/旧行号判断单行变更的 action
+    """
+    action = 'empty line'
+    if c.ln is not None and c.ln2 is not None and c.ln ==c.ln2 :
+        action = 'no_change'
+    elif c.ln is not None and c.ln2 is not None and c.ln !=c.ln2:
+        action = 'Modify'
+    elif c.ln is not None :
+        action = 'Add'
+    elif c.ln2 is not None:
+        action = 'Delete'
+    return action
+
+def format_change(c):
+    """
+    渲染单行变更的行号/action 信息
+    """
+    return f"old_line:{c.ln2 if c.ln2 is not None else 0}, new_line:{c.ln if c.ln is not None else 0}, action:{change_action(c)}, content:{c.content}"
+
+def format_chunk(chunk):
     """
-    根据文件、代码块和 MR 详情构造给 OpenAI 的提示字符串
+    将代码块渲染为 prompt 中的 diff 片段：hunk 原文 + 逐行的行号/action 信息
     """
     diff_changes = ''
     for c in chunk.changes:
-        action = 'empty line'
-        if c.ln is not None and c.ln2 is not None and c.ln ==c.ln2 :
-            action = 'no_change'
-        elif c.ln is not None and c.ln2 is not None and c.ln !=c.ln2:
-            action = 'Modify'
-        elif c.ln is not None :
-            action = 'Add'
-        elif c.ln2 is not None:
-            action = 'Delete'
-        change_info = f"old_line:{c.ln2 if c.ln2 is not None else 0}, new_line:{c.ln if c.ln is not None else 0}, action:{action}, content:{c.content}"
-        diff_changes = diff_changes + "\n" + change_info
-
-    prompt = f"""Your task is to review merge requests,and reply in chinese. Instructions:
-- You Must Provide the response in following JSON format:  {{"reviews": [{{"new_line":  <new_line>, "old_line": <old_line>, "ation": <action>, "reviewComment": "<review comment>"}}]}}
+        diff_changes = diff_changes + "\n" + format_change(c)
+    return f"{chunk.content}\n{diff_changes}"
+
+# 固定的 system prompt：所有请求完全相同，作为 provider 端 prompt 缓存 / 本地 KV 复用的共享前缀
+SYSTEM_PROMPT = """Your task is to review merge requests,and reply in chinese. Instructions:
+- You Must Provide the response in following JSON format:  {"reviews": [{"hunk_id": <hunk_id>, "new_line":  <new_line>, "old_line": <old_line>, "action": <action>, "reviewComment": "<review comment>"}]}
 - Do not give positive comments or compliments.
-- new_line ,old_line and action in response should exactly the same as the provided diff_change info.
+- Every review MUST include the hunk_id of the hunk it refers to, and new_line, old_line and action must come from that hunk's diff_change info.
 - Provide comments and suggestions ONLY if there is something to improve, otherwise "reviews" should be an empty array.
 - Write the comment in GitLab Markdown format.
-- Use the given description only for the overall context and only comment the code.
-- IMPORTANT: NEVER suggest adding comments to the code.
+- Take the merge request title, description and guidelines into account, use them only for the overall context and only comment the code.
+- IMPORTANT: NEVER suggest adding comments to the code."""
+
+# 小模型开启升级时追加在代码块之后的要求
+CONFIDENCE_PROMPT = """
 
-Review the following code diff in the file "{file.to}" and take the merge request title and description into account when writing the response.
+Also add a top-level "confidence" field to the JSON: a number from 0 to 1 for how confident you are that \
+your review found every real problem in these hunks. Use a low value when the change is hard to judge \
+without more context."""
 
-Merge Request title: {pr_details['title']}
+def create_mr_context(pr_details):
+    """
+    每个 MR 固定的上下文（标题、描述、review 规范），同一 MR 的所有请求共享，紧跟在 system prompt 之后
+    """
+    context = f"""Merge Request title: {pr_details['title']}
 Merge Request description:
 
 ---
 {pr_details['description']}
+---"""
+    if REVIEW_GUIDELINES:
+        context += f"""
+
+Review guidelines:
+
 ---
+{REVIEW_GUIDELINES}
+---"""
+    return context
+
+def create_prompt(file, chunk, pr_details):
+    """
+    根据文件、代码块和 MR 详情构造给 OpenAI 的 messages（单个代码块即 hunk_id 为 1 的打包 prompt）
+    """
+    return create_packed_prompt([(file, chunk)], pr_details)
 
-Git diff to review:
+def create_packed_prompt(items, pr_details, confidence=False):
+    """
+    将一个或多个（可能来自不同文件的）代码块放进一次请求的 messages。
+    布局为 [固定 system prompt, 本 MR 上下文, 待 review 的代码块]：前两条消息在同一 MR 的所有请求中逐字相同，
+    只有最后一条随代码块变化，便于 provider 的 prompt 前缀缓存命中。
+    每个代码块以从 1 开始的 hunk_id 标识，模型需在每条 review 中带回 hunk_id；
+    confidence 为 True 时在最后一条消息中要求模型给出 confidence（不影响共享前缀）
+    """
+    with metrics.span("prompt_build", hunks=len(items)):
+        hunks = "\n\n".join(
+            f"""Hunk {hunk_id} in file "{file.to}":
 
 ```diff
-{chunk.content}
-{diff_changes}
+{format_chunk(chunk)}
 ```"""
-    return prompt
+            for hunk_id, (file, chunk) in enumerate(items, 1)
+        )
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": create_mr_context(pr_details)},
+            {"role": "user", "content": f"Git diffs to review:\n\n{hunks}" + (CONFIDENCE_PROMPT if confidence else "")},
+        ]
+
+def review_schema(confidence=False):
+    """
+    reviews 回复的 JSON schema（同一分级的所有请求使用同一个 schema，保持请求前缀一致），
+    confidence 为 True 时（小模型且开启升级）要求顶层给出 0~1 的 confidence
+    """
+    properties = {
+        "hunk_id": {"type": "integer"},
+        "new_line": {"type": "integer"},
+        "old_line": {"type": "integer"},
+        "action": {"type": "string"},
+        "reviewComment": {"type": "string"},
+    }
+    schema = {
+        "type": "object",
+        "properties": {
+            "reviews": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": properties,
+                    "required": list(properties),
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["reviews"],
+        "additionalProperties": False,
+    }
+    if confidence:
+        schema["properties"]["confidence"] = {"type": "number"}
+        schema["required"].append("confidence")
+    return schema
+
+# 结构化输出能力，按 json_schema -> json_object -> none 逐级降级
+OUTPUT_MODES = ("json_schema", "json_object", "none")
+_output_mode = None
+_output_mode_lock = threading.Lock()
 
-def get_ai_response(prompt):
+def current_output_mode():
+    """
+    当前使用的结构化输出方式：INPUT_RESPONSE_FORMAT 指定时直接使用（tools 为 tool calling 输出），
+    auto 时从 json_schema 开始，endpoint 不支持时由 downgrade_output_mode 降级，结果在进程内共享
+    """
+    global _output_mode
+    with _output_mode_lock:
+        if _output_mode is None:
+            _output_mode = OUTPUT_MODES[0] if RESPONSE_FORMAT_MODE == "auto" else RESPONSE_FORMAT_MODE
+        return _output_mode
+
+def downgrade_output_mode(mode, error):
+    """
+    endpoint 因结构化输出参数返回 400/422 时降级到下一种方式，返回是否降级成功（可立即重发请求）
+    """
+    global _output_mode
+    if RESPONSE_FORMAT_MODE != "auto" or mode not in OUTPUT_MODES[:-1]:
+        return False
+    if not isinstance(error, (openai.BadRequestError, openai.UnprocessableEntityError)):
+        return False
+    message = str(error).lower()
+    if not any(word in message for word in ("response_format", "json", "schema", "tool", "support")):
+        return False
+    with _output_mode_lock:
+        if _output_mode == mode:
+            _output_mode = OUTPUT_MODES[OUTPUT_MODES.index(mode) + 1]
+            print(f"Endpoint rejected {mode} output, falling back to {_output_mode}")
+    return True
+
+def output_config(mode, confidence=False):
+    """
+    按结构化输出方式生成 chat.completions.create 的额外参数
+    """
+    if mode == "json_schema":
+        return {"response_format": {"type": "json_schema", "json_schema": {
+            "name": "code_review", "strict": True, "schema": review_schema(confidence)}}}
+    if mode == "json_object":
+        return {"response_format": {"type": "json_object"}}
+    if mode == "tools":
+        return {
+            "tools": [{"type": "function", "function": {
+                "name": "submit_reviews", "description": "Submit the code review comments",
+                "parameters": review_schema(confidence)}}],
+            "tool_choice": {"type": "function", "function": {"name": "submit_reviews"}},
+        }
+    return {}
+
+def create_chat_completion(tier="large", tokens=0, deadline=None, **params):
+    """
+    经后端池（INPUT_LLM_BACKENDS）调用 chat.completions.create，tier 为模型分级，tokens / deadline 交给所选后端的限流器；
+    开启录制 / 回放（INPUT_CASSETTE_MODE）时经 cassette 录制或直接返回录制的结果（params 中的 model 区分了分级）
+    """
+    if cassette:
+        return cassette.chat_completion(lambda: get_llm_pool().create(tier, tokens, deadline, **params), params)
+    return get_llm_pool().create(tier, tokens, deadline, **params)
+
+def get_ai_response(prompt, on_review=None, deadline=None, tier="large", meta=None, usage=None):
     """
     调用 OpenAI 接口生成代码审查建议，返回一个 reviews 数组，
-    每一项格式形如 { "lineNumber": "<line_number>", "reviewComment": "<review comment>" }
+    每一项格式形如 { "hunk_id": <hunk_id>, "new_line": <new_line>, "old_line": <old_line>, "reviewComment": "<review comment>" }
+    prompt 为 create_prompt 生成的 messages 列表（也兼容单个字符串）；deadline 为时间预算，每次尝试的超时为
+    deadline.request_timeout()（留出发布总结的时间），剩余时间不足时不再重试
+    传入 on_review 时每条 review 解析出来后立即回调；流式模式（INPUT_STREAM）下边接收边解析，不等整个回复结束。
+    endpoint 支持时使用 JSON schema / JSON mode / tool calling 结构化输出，回复统一由容错解析器 ReviewStreamParser 单遍解析。
+    tier 为模型分级（small 使用 INPUT_SMALL_MODEL）；传入 meta 字典时要求模型在回复中给出 confidence，解析后写入 meta["confidence"]。
+    用量记入 usage（所属 MR 的 LLMUsage），未传入时记入全局 llm_usage
     """
+    usage = llm_usage if usage is None else usage
     query_config = {
-        "model": OPENAI_API_MODEL,
+        "model": tier_model(tier),
         # "temperature": 0.2,
         # "max_tokens": 700,
         # "top_p": 1,
         # "frequency_penalty": 0,
         # "presence_penalty": 0,
     }
-    # 如果模型支持返回 JSON 对象，可传入相应参数
-    if OPENAI_API_MODEL == "gpt-4-1106-preview":
-        query_config["response_format"] = {"type": "json_object"}
+    if REVIEW_STREAM:
+        query_config["stream"] = True
+        # 流式回复默认不带用量，需显式要求在最后一个事件中返回，否则 token 计数全为 0
+        query_config["stream_options"] = {"include_usage": True}
+    messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    # token 限流按 prompt token 数加上预估的输出长度计算
+    tokens = count_messages_tokens(messages) + 500 if not cassette and get_llm_pool().limits_tokens else 0
     try:
-        response = client.chat.completions.create(
-            **query_config,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        while True:
+            mode = current_output_mode()
+            try:
+                with metrics.span("llm_call", model=query_config["model"], output_mode=mode):
+                    response = llm_scheduler.call(
+                        lambda: create_chat_completion(
+                            tier,
+                            tokens,
+                            deadline,
+                            **query_config,
+                            **output_config(mode, confidence=meta is not None),
+                            **({"timeout": deadline.request_timeout()} if deadline is not None else {}),
+                            messages=messages
+                        ),
+                        deadline=deadline
+                    )
+                break
+            except openai.APIStatusError as e:
+                if not downgrade_output_mode(mode, e):
+                    raise
 
-        res = response.choices[0].message.content.strip() if response.choices and response.choices[0].message else "{}"
-        match = re.search(r"\{.*\}", res, re.DOTALL)
-        json_str = match.group(0)  # 提取匹配到的 JSON
-        print("DEBUG: Extracted JSON:", json_str)
-        return json.loads(json_str).get("reviews")
+        # 除最后一条（代码块）外的消息是可复用的共享前缀
+        prefix_tokens = sum(count_prefix_tokens(m["content"]) for m in messages[:-1])
+        if REVIEW_STREAM:
+            with metrics.span("response_parse", stream=True):
+                return consume_review_stream(response, on_review, prefix_tokens, meta, usage)
+        usage.record_response(response.usage, prefix_tokens)
+        message = response.choices[0].message if response.choices else None
+        if message and message.tool_calls:
+            res = message.tool_calls[0].function.arguments or ""
+        else:
+            res = (message.content or "") if message else ""
+        parser = ReviewStreamParser()
+        with metrics.span("response_parse", stream=False):
+            reviews = parser.feed(res)
+        if meta is not None:
+            meta["confidence"] = response_confidence(res)
+        if not parser.found:
+            raise ValueError(f"no JSON object in response: {res[:200]!r}")
+        if on_review:
+            for review in reviews:
+                on_review(review)
+        return reviews
     except Exception as e:
+        metrics.incr("llm_errors")
         print("Error from OpenAI:", e)
         return None
 
+def consume_review_stream(stream, on_review=None, prefix_tokens=0, meta=None, usage=None):
+    """
+    逐个 token 消费流式 chat completion（普通回复或 tool calling 参数），用 ReviewStreamParser 增量解析，
+    每个 review 对象一完整就回调 on_review；回复中没有任何 JSON 对象时抛出 ValueError。
+    传入 meta 时保留完整回复文本，结束后解析 confidence 写入 meta；用量记入 usage（默认全局 llm_usage）
+    """
+    parser = ReviewStreamParser()
+    reviews = []
+    texts = [] if meta is not None else None
+    reported = None
+    for event in stream:
+        reported = getattr(event, "usage", None) or reported  # 最后一个事件中附带用量
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta
+        text = delta.content
+        if not text and delta.tool_calls:
+            text = delta.tool_calls[0].function.arguments if delta.tool_calls[0].function else None
+        if not text:
+            continue
+        if texts is not None:
+            texts.append(text)
+        for review in parser.feed(text):
+            reviews.append(review)
+            if on_review:
+                on_review(review)
+    (llm_usage if usage is None else usage).record_response(reported, prefix_tokens)
+    if meta is not None:
+        meta["confidence"] = response_confidence("".join(texts))
+    if not parser.found:
+        raise ValueError("no JSON object in streamed response")
+    return reviews
+
+class ReviewStreamParser:
+    """
+    容错的增量 review 解析器：逐段喂入文本，单遍扫描字符，跟踪字符串/转义和括号深度，
+    任何闭合的、带 reviewComment 的对象都立即 json.loads 并产出，不要求外层一定是 {"reviews": [...]}。
+    因此 markdown 代码块、前后多余文字、截断的回复、个别格式错误的对象都不会影响其余 review
+    """
+    _TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+    def __init__(self):
+        self.found = False   # 是否见到过 JSON 对象
+        self._buf = []       # 当前最外层对象的字符
+        self._stack = []     # 未闭合对象的 [起始下标, 是否包含已产出的 review]
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        completed = []
+        for ch in text:
+            if not self._stack:
+                if ch == "{":
+                    self.found = True
+                    self._buf = [ch]
+                    self._stack = [[0, False]]
+                    self._in_string = False
+                    self._escape = False
+                continue
+            self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._stack.append([len(self._buf) - 1, False])
+            elif ch == "}":
+                start, contains_review = self._stack.pop()
+                if not contains_review:
+                    review = self._load("".join(self._buf[start:]))
+                    contains_review = review is not None
+                    if contains_review:
+                        completed.append(review)
+                # 外层容器（如 {"reviews": [...]}）不再重复解析
+                if contains_review and self._stack:
+                    self._stack[-1][1] = True
+                if not self._stack:
+                    self._buf = []
+        return completed
+
+    def _load(self, text):
+        if '"reviewComment"' not in text:
+            return None
+        for candidate in (text, self._TRAILING_COMMA.sub(r"\1", text)):
+            try:
+                review = json.loads(candidate)
+            except ValueError:
+                continue
+            return review if isinstance(review, dict) and "reviewComment" in review else None
+        print("Dropped malformed review object:", text[:200])
+        return None
+
 def create_comment(file, chunk, ai_responses):
     """
     根据 OpenAI 返回的建议，生成符合 GitLab inline comment 格式的评论列表
+    行号通过文件的行索引校验并以 diff 中的实际行号和 action 为准，diff 中不存在的行（模型编造的行号）直接丢弃；
+    不属于本代码块负责范围的行（其他代码块的行、切分窗口开头重叠的上下文行）也丢弃，由负责的代码块评论
     """
     comments = []
+    owned = {id(c) for c in chunk.owned_changes}
     for ai_response in ai_responses:
-        if not file.to:
+        if not file.to or not ai_response.get("reviewComment"):
+            continue
+        try:
+            new_line = int(ai_response.get("new_line") or 0)
+            old_line = int(ai_response.get("old_line") or 0)
+        except (TypeError, ValueError):
+            new_line = old_line = 0
+        change = file.locate(old_line, new_line)
+        if change is None:
+            print(f"Dropped review on nonexistent line {file.to} old_line:{old_line} new_line:{new_line}")
+            metrics.incr("comments_dropped")
+            continue
+        if id(change) not in owned:
+            print(f"Dropped review outside its chunk {file.to} old_line:{old_line} new_line:{new_line}")
+            metrics.incr("comments_dropped")
             continue
         comments.append({
             "body": ai_response.get("reviewComment") + '\n ---this is generate by ai!',
             "path": file.to,
-            "new_line": int( ai_response.get("new_line")) if ai_response.get("new_line") is not None else 0,
-            "old_line": int(ai_response.get("old_line")) if ai_response.get("old_line") is not None else 0,
-            "action":ai_response.get("action")
+            "new_line": change.ln or 0,
+            "old_line": change.ln2 or 0,
+            "action": change_action(change)
         })
     return comments
 
-def analyze_code(parsed_diff, pr_details):
+def chunk_origin(chunk):
+    """ 代码块第一行在旧/新文件中的行号 """
+    old = next((c.ln2 for c in chunk.changes if c.ln2 is not None), 0)
+    new = next((c.ln for c in chunk.changes if c.ln is not None), 0)
+    return old, new
+
+def relative_reviews(reviews, chunk):
+    """
+    将 reviews 的行号转换为相对代码块第一行的偏移（从 1 开始），缓存和跨 MR 复用的结果与代码块在文件中的位置无关
+    """
+    old, new = chunk_origin(chunk)
+    return [_shift_review(review, 1 - old, 1 - new) for review in reviews]
+
+def absolute_reviews(reviews, chunk):
+    """ relative_reviews 的逆操作：按代码块当前的位置还原行号 """
+    old, new = chunk_origin(chunk)
+    return [_shift_review(review, old - 1, new - 1) for review in reviews]
+
+def _shift_review(review, old_delta, new_delta):
+    review = dict(review)
+    for field, delta in (("old_line", old_delta), ("new_line", new_delta)):
+        try:
+            line = int(review.get(field) or 0)
+        except (TypeError, ValueError):
+            line = 0
+        # 0 表示该侧不存在；平移后落到代码块之前的行号也记为 0，之后由 create_comment 校验丢弃
+        review[field] = max(0, line + delta) if line else 0
+    return review
+
+class ReviewDeduper:
+    """
+    批量 review 多个 MR 时，相同的代码块（cherry-pick、backport 到 release 分支等）只调用一次 LLM：
+    第一个 claim 到某个 key 的线程负责 review 并 resolve，其他线程 wait 该结果后复用。
+    持有者总是先 resolve 自己的代码块再等待别人的，不会互相等待
+    """
+    def __init__(self):
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> [threading.Event, reviews（相对行号），失败时为 None]
+
+    def claim(self, key):
+        """ 返回 (是否由当前线程负责 review, 结果条目) """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.reused += 1
+                metrics.incr("hunks_deduplicated")
+                return False, entry
+            entry = self._entries[key] = [threading.Event(), None]
+            return True, entry
+
+    def resolve(self, key, reviews):
+        with self._lock:
+            entry = self._entries[key]
+            if reviews is None:
+                del self._entries[key]  # 失败的结果不复用，之后再遇到时重新 review
+        entry[1] = reviews
+        entry[0].set()
+
+    @staticmethod
+    def wait(entry):
+        entry[0].wait()
+        return entry[1]
+
+def review_with_cascade(items, pr_details, on_review, deadline=None, tier="large"):
+    """
+    用 tier 对应的模型 review 一组代码块。小模型且设置了 INPUT_CASCADE_ESCALATE_BELOW 时，先缓存小模型的 reviews，
+    confidence 达到阈值才交给 on_review；confidence 过低、没有给出或调用失败时改由大模型重新 review，
+    小模型的结果丢弃，不会发布两遍评论
+    """
+    if tier != "small" or CASCADE_ESCALATE_BELOW <= 0:
+        return get_ai_response(create_packed_prompt(items, pr_details), on_review, deadline, tier,
+                               usage=pr_details.get("usage"))
+    meta = {}
+    buffered = []
+    reviews = get_ai_response(create_packed_prompt(items, pr_details, confidence=True), buffered.append, deadline,
+                              tier, meta, pr_details.get("usage"))
+    confidence = meta.get("confidence")
+    if reviews is not None and confidence is not None and confidence >= CASCADE_ESCALATE_BELOW:
+        for review in buffered:
+            on_review(review)
+        return reviews
+    metrics.incr("cascade_escalations")
+    print(f"Escalating {len(items)} chunks from {CASCADE_SMALL_MODEL} to {OPENAI_API_MODEL} (confidence {confidence})")
+    return get_ai_response(create_packed_prompt(items, pr_details), on_review, deadline, "large",
+                           usage=pr_details.get("usage"))
+
+def review_chunks(items, pr_details, publisher=None, cache=None, deadline=None, dedup=None):
+    """
+    review 一组 (file, chunk)：先查缓存，未命中的代码块合并为一次 LLM 调用（只有一个时使用单块 prompt），
+    再按 hunk_id 将 reviews 拆回各代码块。每条 review 一到达（流式模式下为边生成边解析）就转换为评论并发布。
+    传入 dedup 时，其他线程（其他 MR）正在 review 或已 review 过的相同代码块直接复用其结果。
+    返回与 items 一一对应的评论列表，失败的代码块为 None；时间预算已不足以发起新请求时全部为 SKIPPED
+    """
+    if deadline is not None and not deadline.can_start():
+        return [SKIPPED] * len(items)
+    responses = [None] * len(items)
+    tiers = [route_tier(file, chunk) for file, chunk in items]
+    # 缓存按代码块自身路由到的模型区分；被升级或与大模型代码块打包时，存入的是更强模型的结果
+    cache_keys = [ReviewCache.key(file, chunk, tier_model(tier)) if cache or dedup else None
+                  for (file, chunk), tier in zip(items, tiers)]
+    if cache:
+        responses = [cache.get(key) for key in cache_keys]
+        responses = [absolute_reviews(r, items[i][1]) if r is not None else None for i, r in enumerate(responses)]
+    waiting = {}  # 下标 -> 其他线程负责 review 的 dedup 条目
+    if dedup:
+        for i, response in enumerate(responses):
+            if response is None:
+                owner, entry = dedup.claim(cache_keys[i])
+                if not owner:
+                    waiting[i] = entry
+    # 本线程负责 review 的 dedup 条目，出错时必须 resolve，否则等待它的线程会一直阻塞
+    owned = {i for i, response in enumerate(responses) if response is None and i not in waiting} if dedup else set()
+    try:
+        results = [None] * len(items)
+
+        def emit(i, review):
+            file, chunk = items[i]
+            comments = create_comment(file, chunk, [review])
+            results[i].extend(comments)
+            if publisher and comments:
+                # 发布失败只影响这条评论：不能冒泡到 LLM 调用里，否则已解析的 reviews 会被当作 LLM 失败丢弃、不写缓存，
+                # 同一 prompt 中其余代码块的评论也会丢失；reviews 写入缓存后，下次运行命中缓存时会重新发布
+                try:
+                    publisher.publish(comments)
+                except Exception as e:
+                    metrics.incr("comments_failed")
+                    print(f"Error publishing comment on {file.to}:", e)
+
+        for i, response in enumerate(responses):
+            if response is not None:
+                results[i] = []
+                for review in response:
+                    emit(i, review)
+
+        pending = [i for i, response in enumerate(responses) if response is None and i not in waiting]
+        for i in pending:
+            responses[i] = []
+            results[i] = []
+
+        def on_review(review):
+            if len(pending) == 1:
+                index = pending[0]  # 单个代码块时不依赖模型带回的 hunk_id
+            else:
+                try:
+                    hunk_id = int(review.get("hunk_id"))
+                except (TypeError, ValueError):
+                    return
+                if not 1 <= hunk_id <= len(pending):
+                    return
+                index = pending[hunk_id - 1]
+            responses[index].append(review)
+            emit(index, review)
+        if pending:
+            # 同一个 prompt 中只要有一个代码块需要大模型，整个 prompt 都发给大模型
+            tier = "large" if any(tiers[i] == "large" for i in pending) else "small"
+            metrics.incr(f"hunks_routed_{tier}", len(pending))
+            ai_response = review_with_cascade([items[i] for i in pending], pr_details, on_review, deadline, tier)
+        else:
+            ai_response = []
+        if ai_response is None:
+            for i in pending:
+                results[i] = None  # LLM 调用失败
+        for i in pending:
+            reviews = relative_reviews(responses[i], items[i][1]) if ai_response is not None else None
+            if dedup:
+                dedup.resolve(cache_keys[i], reviews)
+                owned.discard(i)
+            if cache and reviews is not None:
+                cache.set(cache_keys[i], reviews)
+    except BaseException:
+        for i in owned:
+            dedup.resolve(cache_keys[i], None)
+        raise
+
+    # 自己负责的代码块都已 resolve，再等待其他线程负责的相同代码块
+    for i, entry in waiting.items():
+        reviews = dedup.wait(entry)
+        if reviews is None:
+            continue  # 对方 review 失败，本代码块同样记为失败
+        results[i] = []
+        for review in absolute_reviews(reviews, items[i][1]):
+            emit(i, review)
+    return results
+
+def analyze_code(parsed_diff, pr_details, max_workers=None, publisher=None, cache=None, stats=None,
+                 pack_tokens=None, deadline=None, executor=None, dedup=None):
     """
     遍历所有文件和代码块，调用 OpenAI 获取审查建议，并汇总所有评论
+    parsed_diff 可以是生成器：每个文件一产出就把它的代码块提交到有界线程池，不等待整个 diff 解析完；
+    pack_tokens > 0 时需要全局装箱，代码块会先收集再按 token 预算打包提交。
+    传入 deadline 时同样先收集全部代码块，按 risk_score 从高到低提交，预算不足时剩余代码块跳过，
+    并在 MR 上发布一条列出未 review 代码块的总结。
+    传入 executor 时使用调用方的线程池（批量模式下多个 MR 共享），否则新建 max_workers 大小的线程池。
+    结果按文件/代码块的原始顺序收集；传入 stats 字典时写入 reviewed / failed / skipped 等统计
     """
+    stats = {} if stats is None else stats
+    stats.setdefault("reviewed", 0)
+    stats.setdefault("failed", 0)
+    stats.setdefault("skipped", [])
+    usage = pr_details.setdefault("usage", LLMUsage())
+    usage_before = usage.snapshot()
+    max_workers = max_workers or REVIEW_CONCURRENCY
+    pack_tokens = REVIEW_PACK_TOKENS if pack_tokens is None else pack_tokens
+    publisher = publisher or CommentPublisher(pr_details)
+    stats["budget"] = {"split": [], "skipped": []}
+    collect = pack_tokens > 0 or deadline is not None
+    results = []  # 按代码块在 diff 中的位置存放结果，保证输出顺序确定
+    labels = []   # 时间预算模式下各代码块的位置描述，用于总结
+    futures = []  # (代码块下标列表, future)
+    collected = []  # 需要全局排序/装箱时先收集的 (下标, (file, chunk))
+    pool = contextlib.nullcontext(executor) if executor else ThreadPoolExecutor(max_workers=max_workers)
+    with pool as executor:
+        for file in parsed_diff:
+            if file.to == "/dev/null":
+                continue  # 忽略已删除的文件
+            file = budget_file(file, stats["budget"])
+            if file is None:
+                continue
+            for chunk in file.chunks:
+                index = len(results)
+                results.append(None)
+                if deadline is not None:
+                    labels.append(chunk_label(file, chunk))
+                if collect:
+                    collected.append((index, (file, chunk)))
+                else:
+                    futures.append(([index], executor.submit(
+                        metrics.bind(review_chunks), [(file, chunk)], pr_details, publisher, cache, None, dedup)))
+        if collected:
+            items = [item for _, item in collected]
+            if pack_tokens > 0:
+                # 按模型分级分别装箱，小模型的代码块不会因为和复杂代码块打包而被发给大模型
+                by_tier = {}
+                for item in items:
+                    by_tier.setdefault(route_tier(*item), []).append(item)
+                groups = [group for tier_items in by_tier.values() for group in pack_chunks(tier_items, pack_tokens)]
+                print(f"Packed {len(items)} chunks into {len(groups)} prompts")
+            else:
+                groups = [[item] for item in items]
+            if deadline is not None:
+                scores = {id(chunk): risk_score(file, chunk) for file, chunk in items}
+                groups.sort(key=lambda group: max(scores[id(chunk)] for _, chunk in group), reverse=True)
+            position = {id(chunk): index for index, (_, chunk) in collected}
+            for group in groups:
+                indexes = [position[id(chunk)] for _, chunk in group]
+                futures.append((indexes, executor.submit(
+                    metrics.bind(review_chunks), group, pr_details, publisher, cache, deadline, dedup)))
+        for indexes, future in futures:
+            for index, result in zip(indexes, future.result()):
+                results[index] = result
+    if not results:
+        print("No diff found")
+    report_diff_completeness(pr_details)
+    print_budget_report(stats["budget"])
     comments = []
-    for file in parsed_diff:
-        if file.to == "/dev/null":
-            continue  # 忽略已删除的文件
-        for chunk in file.chunks:
-            prompt = create_prompt(file, chunk, pr_details)
-            ai_response = get_ai_response(prompt)
-            if ai_response:
-                new_comments = create_comment(file, chunk, ai_response)
-                if new_comments:
-                    comments.extend(new_comments)
-        if comments:
-            create_review_comments(pr_details, comments)
+    for index, new_comments in enumerate(results):
+        if new_comments is SKIPPED:
+            stats["skipped"].append(labels[index])
+            continue
+        if new_comments is None:
+            stats["failed"] += 1
+            continue
+        stats["reviewed"] += 1
+        comments.extend(new_comments)
+    print(f"Reviewed {stats['reviewed']} chunks, {stats['failed']} failed, {len(stats['skipped'])} skipped")
+    metrics.incr("hunks_reviewed", stats["reviewed"])
+    metrics.incr("hunks_failed", stats["failed"])
+    metrics.incr("hunks_skipped_deadline", len(stats["skipped"]))
+    if stats["skipped"]:
+        publish_skipped_summary(publisher, stats["skipped"])
+    print(f"Published {publisher.posted} comments, skipped {publisher.skipped} already posted")
+    if cache:
+        print(f"Review cache: {cache.hits} hits, {cache.misses} misses")
+    stats["llm"] = report_prefix_reuse(usage.since(usage_before))
+    print_backend_report()
     return comments
 
+def publish_skipped_summary(publisher, skipped, limit=100):
+    """
+    时间预算耗尽时在 MR 上发布一条总结，列出未被 review 的代码块
+    """
+    lines = [f"- `{label}`" for label in skipped[:limit]]
+    if len(skipped) > limit:
+        lines.append(f"- ... 以及另外 {len(skipped) - limit} 个代码块")
+    body = (f"AI review 超出时间预算，已按风险优先级 review 了其余代码块，以下 {len(skipped)} 个代码块未被 review：\n\n"
+            + "\n".join(lines) + "\n\n ---this is generate by ai!")
+    publisher.publish_note(body)
+
+def report_prefix_reuse(usage):
+    """
+    打印本 MR 的共享前缀复用情况：同一 MR 的每次请求前缀相同，第一次之后的请求都可以复用，
+    provider 返回 cached_tokens 时一并打印实际命中的缓存 token 数
+    """
+    calls = usage["calls"]
+    if calls:
+        reused = usage["prefix_tokens"] - usage["prefix_tokens"] // calls
+        usage["reused_prefix_tokens"] = reused
+        print(f"LLM calls: {calls}, shared prompt prefix {usage['prefix_tokens'] // calls} tokens, "
+              f"{reused} prefix tokens reusable, {usage['cached_tokens']} prompt tokens cached by provider")
+    return usage
+
 
 #############################################
-# GitLab MR inline 评论相关函数
+# review 结果缓存
 #############################################
-def create_discussion(project_id, mr_iid, comment, pr_details):
+class ReviewCache:
     """
-    通过 GitLab API 将单条评论以讨论的方式添加到 Merge Request 中
-    需要提供 position 信息（基于 MR diff refs）
+    基于 SQLite 的内容寻址 review 缓存
+    key 为 hunk 内容、文件路径、模型名和 prompt 版本的哈希，value 为解析后的 reviews 列表；
+    超过 ttl 的条目失效，条目数超过 max_entries 时按最近访问时间淘汰
     """
+    def __init__(self, path, ttl=REVIEW_CACHE_TTL, max_entries=REVIEW_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reviews ("
+                "key TEXT PRIMARY KEY, reviews TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reviewed_heads ("
+                "project_id TEXT NOT NULL, mr_iid TEXT NOT NULL, head_sha TEXT NOT NULL, "
+                "reviewed_at REAL NOT NULL, PRIMARY KEY (project_id, mr_iid))"
+            )
+            self._conn.execute("DELETE FROM reviews WHERE created_at < ?", (time.time() - self.ttl,))
+            self._evict()
+
+    @staticmethod
+    def key(file, chunk, model=None):
+        digest = hashlib.sha256()
+        for part in (PROMPT_VERSION, model or OPENAI_API_MODEL, file.to or "", chunk.content):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT reviews FROM reviews WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.incr("cache_misses")
+                return None
+            self.hits += 1
+            metrics.incr("cache_hits")
+            self._conn.execute("UPDATE reviews SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def set(self, key, reviews):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reviews (key, reviews, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(reviews, ensure_ascii=False), now, now)
+            )
+            self._evict()
+
+    def _evict(self):
+        # 调用方需持有锁；只保留最近访问的 max_entries 条
+        self._conn.execute(
+            "DELETE FROM reviews WHERE key IN ("
+            "SELECT key FROM reviews ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
 
-    project = gl.projects.get(project_id)
-    mr = project.mergerequests.get(mr_iid)
+    def get_reviewed_head(self, project_id, mr_iid):
+        """ 返回该 MR 上一次完整 review 过的 head_sha """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT head_sha FROM reviewed_heads WHERE project_id = ? AND mr_iid = ?",
+                (str(project_id), str(mr_iid))
+            ).fetchone()
+        return row[0] if row else None
 
+    def set_reviewed_head(self, project_id, mr_iid, head_sha):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO reviewed_heads (project_id, mr_iid, head_sha, reviewed_at) VALUES (?, ?, ?, ?)",
+                (str(project_id), str(mr_iid), head_sha, time.time())
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def open_review_cache(path=None):
+    """
+    按 INPUT_CACHE_PATH 打开 review 缓存，未配置或打开失败时返回 None（不使用缓存）
+    """
+    path = REVIEW_CACHE_PATH if path is None else path
+    if not path:
+        return None
+    try:
+        return ReviewCache(path)
+    except sqlite3.Error as e:
+        print("Error opening review cache:", e)
+        return None
+
+
+#############################################
+# GitLab MR inline 评论相关函数
+#############################################
+def build_position(comment, pr_details):
+    """
+    根据评论的行号和 action 构造 GitLab discussion 的 position 信息（基于 MR diff refs）
+    """
     # 构造位置信息（关键参数）
     old_line = comment['old_line']
     new_line = comment['new_line']
@@ -268,9 +2712,9 @@ def create_discussion(project_id, mr_iid, comment, pr_details):
 
     position = {
         "position_type": "text",  # 固定值
-        "base_sha": mr.diff_refs["base_sha"],
-        "head_sha": mr.diff_refs["head_sha"],
-        "start_sha": mr.diff_refs["start_sha"],
+        "base_sha": pr_details["base_sha"],
+        "head_sha": pr_details["head_sha"],
+        "start_sha": pr_details["start_sha"],
         "new_path": comment["path"],
         "old_path": comment["path"],
 
@@ -295,76 +2739,375 @@ def create_discussion(project_id, mr_iid, comment, pr_details):
                  "new_line":   new_line
             }
         }
+    return position
+
+def create_discussion(mr, comment, pr_details, position=None):
+    """
+    通过 GitLab API 将单条评论以讨论的方式添加到 Merge Request 中
+    需要提供 position 信息（基于 MR diff refs）
+    """
+    if position is None:
+        position = build_position(comment, pr_details)
 
-    # 创建行内评论
-    discussion = mr.discussions.create({
-        "body": comment["body"],
-        "position": position
-    })
+    # 创建行内评论（经 GitLab 调度器限流，只在 429 时重试；429 由调度器处理，python-gitlab 不再重复重试）
+    with metrics.span("publish", path=comment["path"]):
+        discussion = gitlab_scheduler.call(lambda: mr.discussions.create({
+            "body": comment["body"],
+            "position": position
+        }, obey_rate_limit=False), idempotent=False)
     print(discussion)
 
 def generate_line_code(fileName, old_line=None, new_line=None):
     """ 生成 GitLab `line_code`（唯一标识某一行） """
     return f"{hashlib.sha1(fileName.encode()).hexdigest()}_{old_line or 0}_{new_line or 0}"
 
+def comment_key(position, body):
+    """
+    评论去重索引的 key：文件路径 + 新/旧行号 + 评论内容的哈希
+    """
+    return (
+        position.get("new_path"),
+        position.get("new_line"),
+        position.get("old_line"),
+        hashlib.sha1((body or "").strip().encode()).hexdigest()
+    )
+
+class CommentPublisher:
+    """
+    MR 评论发布器
+    第一次发布时拉取一次 MR 已有的讨论并建立 path/line/body 哈希索引（没有评论要发布时不请求），
+    之后只发布索引中不存在的评论，流水线重试时不会重复写入。可被多个 worker 线程同时调用
+    """
+    def __init__(self, pr_details):
+        self.pr_details = pr_details
+        self.mr = pr_details["session"].mr
+        self.posted = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _load_index(self):
+        # 调用方需持有锁
+        if self._index is not None:
+            return self._index
+        self._index = set()
+        for discussion in self.mr.discussions.list(get_all=True):
+            for note in discussion.attributes.get("notes", []):
+                if note.get("position"):
+                    self._index.add(comment_key(note["position"], note.get("body")))
+                else:
+                    self._index.add(comment_key({}, note.get("body")))
+        return self._index
+
+    def publish(self, comments):
+        for comment in comments:
+            position = build_position(comment, self.pr_details)
+            key = comment_key(position, comment["body"])
+            with self._lock:
+                index = self._load_index()
+                if key in index:
+                    self.skipped += 1
+                    metrics.incr("comments_duplicate")
+                    continue
+                index.add(key)
+            try:
+                create_discussion(self.mr, comment, self.pr_details, position)
+            except Exception:
+                with self._lock:
+                    self._index.discard(key)
+                raise
+            with self._lock:
+                self.posted += 1
+            metrics.incr("comments_posted")
+
+    def publish_note(self, body):
+        """
+        发布不关联代码行的 MR 评论（如总结），内容相同的评论已存在时跳过
+        """
+        key = comment_key({}, body)
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                self.skipped += 1
+                metrics.incr("comments_duplicate")
+                return
+            index.add(key)
+        try:
+            with metrics.span("publish", note=True):
+                gitlab_scheduler.call(lambda: self.mr.notes.create({"body": body}, obey_rate_limit=False),
+                                      idempotent=False)
+        except Exception:
+            with self._lock:
+                self._index.discard(key)
+            raise
+        with self._lock:
+            self.posted += 1
+        metrics.incr("comments_posted")
+
 def create_review_comments(pr_details, comments):
     """
-    将所有评论逐条以讨论的方式发布到 Merge Request 中
+    将所有评论逐条以讨论的方式发布到 Merge Request 中（已存在的评论会被跳过）
     """
-    project_id = pr_details["project_id"]
-    mr_iid = pr_details["mr_iid"]
-    for comment in comments:
-        create_discussion(project_id, mr_iid, comment, pr_details)
+    CommentPublisher(pr_details).publish(comments)
 
 
 #############################################
 # 主函数
 #############################################
-def start_ai_code_review(project_name=None, project_id=None, merge_id=None, branch=None, target_branch=None):
+def apply_incremental_review(session, pr_details, parsed_diff, cache):
+    """
+    增量模式下按上次 review 的 head_sha 过滤 diff；没有可用的历史记录时返回完整 diff
+    """
+    if not cache:
+        print("Incremental review needs the review cache (INPUT_CACHE_PATH), falling back to full review")
+        return parsed_diff
+    last_head = cache.get_reviewed_head(pr_details["project_id"], pr_details["mr_iid"])
+    head_sha = pr_details["head_sha"]
+    if not last_head:
+        return parsed_diff
+    if last_head == head_sha:
+        print(f"No new commits since last review at {head_sha}")
+        return []
+    touched = get_incremental_lines(session, last_head, head_sha)
+    if touched is None:
+        print(f"Last reviewed head {last_head} is not an MR version, falling back to full review")
+        return parsed_diff
+    print(f"Incremental review since {last_head}: {len(touched)} files changed")
+    return filter_incremental(parsed_diff, touched)
+
+
+def review_merge_request(project_id, merge_id, cache=None, time_budget=None, gl_client=None, executor=None,
+                         dedup=None):
+    """
+    review 单个 Merge Request 并发布评论，返回 analyze_code 的统计信息；出错时直接抛出异常。
+    无论成功与否，本 MR 的汇总（耗时、review / 失败 / 跳过 / 排除的代码块数、token 用量）都记入 metrics 的运行报告；
+    传入 cache 时复用调用方的 review 缓存（由调用方负责关闭），否则按 INPUT_CACHE_PATH 打开并在结束时关闭；
+    executor / dedup 供批量模式在多个 MR 间共享线程池和相同代码块的 review 结果
+    """
+    summary = {"project_id": str(project_id), "merge_request_iid": str(merge_id), "status": "error"}
+    started = time.perf_counter()
     try:
-        # 获取 MR 详情（标题、描述、diff refs 等）
-        pr_details = get_pr_details(project_id, merge_id)
-        project_id = pr_details["project_id"]
-        mr_iid = pr_details["mr_iid"]
-
-        # 获取 Merge Request 的 diff（raw diff 格式）
-        diff = get_diff(project_id, mr_iid)
-        if not diff:
-            print("No diff found")
-            return
+        with metrics.span("merge_request", project_id=str(project_id), merge_request_iid=str(merge_id)):
+            stats = _review_merge_request(project_id, merge_id, cache, time_budget, gl_client, executor, dedup)
+        summary.update(
+            status="ok", reviewed=stats["reviewed"], failed=stats["failed"], skipped=len(stats["skipped"]),
+            excluded=stats["excluded"], trivial=stats["trivial"],
+            over_token_budget=len(stats["budget"]["skipped"]), split=len(stats["budget"]["split"]),
+            llm={key: stats["llm"][key] for key in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens")},
+        )
+        return stats
+    finally:
+        summary["duration_s"] = round(time.perf_counter() - started, 3)
+        metrics.record_merge_request(summary)
 
-        # 解析 diff，构造文件、代码块等数据结构
-        parsed_diff = parse_diff(diff)
+def _review_merge_request(project_id, merge_id, cache, time_budget, gl_client, executor, dedup):
+    time_budget = REVIEW_TIME_BUDGET if time_budget is None else time_budget
+    # 时间预算从开始 review 时计算，包含获取 diff 的时间
+    deadline = Deadline(time_budget) if time_budget > 0 else None
 
-        # 根据环境变量 INPUT_EXCLUDE 排除不需要处理的文件（逗号分隔）
-        exclude_input = os.getenv("INPUT_EXCLUDE", "vendor/**,test/**")
-        exclude_patterns = [s.strip() for s in exclude_input.split(",") if s.strip()]
-        filtered_diff = [
-            file for file in parsed_diff
-            if not any(fnmatch.fnmatch(file.to, pattern) for pattern in exclude_patterns)
-        ]
+    # 整个运行共享同一个 MR session，project / MR / changes 只拉取一次
+    session = MRSession(project_id, merge_id, gl_client)
+
+    # 获取 MR 详情（标题、描述、diff refs 等）
+    pr_details = get_pr_details(session)
+
+    # 根据环境变量 INPUT_EXCLUDE 排除不需要处理的文件（逗号分隔）
+    exclude_input = os.getenv("INPUT_EXCLUDE", "vendor/**,test/**")
+    exclude_patterns = [s.strip() for s in exclude_input.split(",") if s.strip()]
+    gitattributes = load_gitattributes(session) if REVIEW_EXCLUDE_GENERATED else ""
+    matcher = ExcludeMatcher(exclude_patterns, gitattributes, REVIEW_EXCLUDE_GENERATED)
+
+    # 流式获取并解析 Merge Request 的 diff：逐个文件过滤、解析为 DiffFile，解析完一个就开始 review 一个
+    filtered_diff = iter_diff_files(session, matcher)
+
+    own_cache = cache is None
+    if own_cache:
+        cache = open_review_cache()
+    try:
+        # 增量模式：只 review 上次 review 之后新提交改动到的代码块
+        if REVIEW_INCREMENTAL:
+            filtered_diff = apply_incremental_review(session, pr_details, filtered_diff, cache)
+
+        # 本地预过滤：纯格式改动、纯删除、import 重排、版本号升级的代码块不发给 LLM
+        trivial = {}
+        if REVIEW_SKIP_TRIVIAL:
+            filtered_diff = filter_trivial(filtered_diff, trivial)
 
         # 调用 OpenAI 分析代码 diff，生成 review 评论
-        comments = analyze_code(filtered_diff, pr_details)
+        stats = {}
+        analyze_code(filtered_diff, pr_details, cache=cache, stats=stats, deadline=deadline, executor=executor,
+                     dedup=dedup)
+        print_exclude_report(matcher.report)
+        print_trivial_report(trivial)
+        stats["excluded"] = matcher.report
+        stats["trivial"] = trivial
+
+        # 全部代码块都 review 成功后才记录本次 head_sha，失败或被跳过的代码块下次仍会被 review
+        if REVIEW_INCREMENTAL and cache and not stats["failed"] and not stats["skipped"]:
+            cache.set_reviewed_head(pr_details["project_id"], pr_details["mr_iid"], pr_details["head_sha"])
+    finally:
+        if own_cache and cache:
+            cache.close()
+    return stats
+
+
+def parse_since(value):
+    """
+    解析批量模式的 --updated-since：ISO 8601 时间原样使用，也支持 30m / 24h / 7d 这样的相对时间
+    """
+    match = re.fullmatch(r"(\d+)([mhd])", value.strip())
+    if not match:
+        return value
+    unit = {"m": "minutes", "h": "hours", "d": "days"}[match.group(2)]
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(**{unit: int(match.group(1))})
+    return since.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def iter_batch_targets(merge_requests=(), projects=(), updated_since=None, gl_client=None):
+    """
+    产出批量模式要 review 的 (project, mr_iid)：merge_requests 为 "project!iid" 形式的列表（project 可以是 ID 或路径），
+    projects 中的项目列出 updated_since 之后更新过的所有 open MR
+    """
+    gl_client = gl_client or get_gitlab_client()
+    seen = set()
+    targets = []
+    for spec in merge_requests:
+        project, _, mr_iid = spec.strip().rpartition("!")
+        if not project or not mr_iid:
+            raise ValueError(f"Invalid merge request {spec!r}, expected project!iid")
+        targets.append((project, mr_iid))
+    for project in projects:
+        filters = {"state": "opened"}
+        if updated_since:
+            filters["updated_after"] = updated_since
+        mrs = gl_client.projects.get(project, lazy=True).mergerequests.list(iterator=True, **filters)
+        targets.extend((project, mr.iid) for mr in mrs)
+    for project, mr_iid in targets:
+        key = (str(project), str(mr_iid))
+        if key not in seen:
+            seen.add(key)
+            yield key
+
+def review_batch(targets, mr_concurrency=None):
+    """
+    在一个进程内 review 多个 MR：共享代码块线程池（INPUT_CONCURRENCY）、限流器、review 缓存，
+    相同的代码块只 review 一次。单个 MR 失败不影响其他 MR，返回失败的 MR 数
+    """
+    tracer_provider = setup_tracing()
+    cache = open_review_cache()
+    dedup = ReviewDeduper()
+    failed = reviewed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=REVIEW_CONCURRENCY) as executor, \
+                ThreadPoolExecutor(max_workers=mr_concurrency or BATCH_MR_CONCURRENCY) as mr_executor:
+            futures = [
+                (target, mr_executor.submit(review_merge_request, *target, cache=cache, executor=executor, dedup=dedup))
+                for target in targets
+            ]
+            for (project, mr_iid), future in futures:
+                try:
+                    future.result()
+                    reviewed += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"Error reviewing merge request {project}!{mr_iid}:", e)
+    finally:
+        if cache:
+            cache.close()
+        write_run_report()
+        if tracer_provider:
+            tracer_provider.shutdown()
+    print(f"Batch review: {reviewed} merge requests reviewed, {failed} failed, "
+          f"{dedup.reused} duplicate chunks reused across merge requests")
+    return failed
+
+
+def measure_import_time():
+    """
+    在子进程中用 python -X importtime 导入本模块，返回 (总耗时毫秒, 耗时最多的顶层依赖列表)
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=directory, capture_output=True, text=True, check=True)
+    children = []
+    for line in result.stderr.splitlines():
+        # 格式：import time: self [us] | cumulative | imported package，缩进表示嵌套层级，子模块先于父模块输出
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2][1:].rstrip()
+        cumulative = int(parts[1]) / 1000
+        if not name.startswith(" "):
+            if name == module:
+                return cumulative, sorted(children, reverse=True)[:5]
+            children = []
+        elif not name.startswith("   "):
+            children.append((cumulative, name.strip()))
+    raise RuntimeError(f"{module} not found in -X importtime output")
+
+def check_import_time(budget_ms=None):
+    """
+    检查导入本模块的耗时不超过预算，超出时返回 False（打印耗时最多的依赖，通常是误把重量级 SDK 改回了顶层导入）
+    """
+    budget_ms = IMPORT_TIME_BUDGET_MS if budget_ms is None else budget_ms
+    total, slowest = measure_import_time()
+    print(f"Import time: {total:.1f} ms (budget {budget_ms:.0f} ms)")
+    for cumulative, name in slowest:
+        print(f"  {cumulative:8.1f} ms  {name}")
+    return total <= budget_ms
+
+
+def start_ai_code_review(project_name=None, project_id=None, merge_id=None, branch=None, target_branch=None,
+                         time_budget=None):
+    tracer_provider = setup_tracing()
+    try:
+        review_merge_request(project_id, merge_id, time_budget=time_budget)
     except Exception as e:
         print("Error:", e)
         sys.exit(1)
+    finally:
+        write_run_report()
+        if tracer_provider:
+            tracer_provider.shutdown()
 
 
 if __name__ == "__main__":
-    project = ""
-    source_branch = ""
-    target_branch = ""
-    project_id = ""
-    merge_id = ""
+    parser = argparse.ArgumentParser(description="AI code review for GitLab merge requests")
+    parser.add_argument("project", nargs="?", help="项目名称（CI_PROJECT_NAME）")
+    parser.add_argument("source_branch", nargs="?", help="源分支")
+    parser.add_argument("target_branch", nargs="?", help="目标分支")
+    parser.add_argument("project_id", nargs="?", help="项目 ID（CI_PROJECT_ID）")
+    parser.add_argument("merge_id", nargs="?", help="Merge Request IID（CI_MERGE_REQUEST_IID）")
+    parser.add_argument("--time-budget", type=float, default=REVIEW_TIME_BUDGET,
+                        help="review 的时间预算（秒），超出时按风险优先级跳过剩余代码块，默认读取 INPUT_TIME_BUDGET")
+    parser.add_argument("--mr", action="append", default=[],
+                        help="批量模式：要 review 的 MR，格式 project!iid，可重复或用逗号分隔")
+    parser.add_argument("--projects", default="",
+                        help="批量模式：review 这些项目（ID 或路径，逗号分隔）中所有 open 的 MR")
+    parser.add_argument("--updated-since",
+                        help="批量模式：只 review 该时间之后更新过的 MR，ISO 8601 时间或 30m / 24h / 7d")
+    parser.add_argument("--import-time-budget", type=float, nargs="?", const=IMPORT_TIME_BUDGET_MS,
+                        help="只检查导入本模块的耗时（毫秒）是否在预算内，超出时退出码为 1，默认读取 INPUT_IMPORT_TIME_BUDGET_MS")
+    args = parser.parse_args()
+    if args.import_time_budget is not None:
+        sys.exit(0 if check_import_time(args.import_time_budget) else 1)
     try:
-        project = sys.argv[1]
-        source_branch = sys.argv[2]
-        target_branch = sys.argv[3]
-        project_id = sys.argv[4]
-        merge_id = sys.argv[5]
-    except Exception as e:
-        print(e)
+        validate_config()
+    except ValueError as e:
+        print("Error:", e)
         sys.exit(1)
-    start_ai_code_review(project,project_id,merge_id,source_branch,target_branch)
-
+    batch_mrs = [spec for value in args.mr for spec in value.split(",") if spec.strip()]
+    batch_projects = [p.strip() for p in args.projects.split(",") if p.strip()]
+    if batch_mrs or batch_projects:
+        since = parse_since(args.updated_since) if args.updated_since else None
+        try:
+            targets = list(iter_batch_targets(batch_mrs, batch_projects, since))
+        except Exception as e:
+            print("Error:", e)
+            sys.exit(1)
+        print(f"Batch review of {len(targets)} merge requests")
+        sys.exit(1 if review_batch(targets) else 0)
+    if not args.project_id or not args.merge_id:
+        parser.error("project_id and merge_id are required unless --mr or --projects is given")
+    start_ai_code_review(args.project, args.project_id, args.merge_id, args.source_branch, args.target_branch,
+                         time_budget=args.time_budget)
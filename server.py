@@ -0,0 +1,193 @@
+"""
+常驻服务模式：接收 GitLab Merge Request webhook，任务排队后由 worker 线程池执行 review。
+进程内复用 main.py 中带连接池的 OpenAI / GitLab 客户端、限流器和 review 缓存，
+每个 MR 的 review 不再有 pip install、导入 SDK、创建客户端的冷启动开销。
+
+启动：python server.py（或 uvicorn server:app --host 0.0.0.0 --port 8080）
+在 GitLab 项目的 Settings -> Webhooks 中添加 http://<host>:8080/webhook，勾选 Merge request events，
+Secret token 与 INPUT_WEBHOOK_SECRET 一致
+"""
+import os
+import hmac
+import queue
+import threading
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+import main
+
+# webhook 校验用的 Secret token（对应请求头 X-Gitlab-Token），为空时不校验
+WEBHOOK_SECRET = os.getenv("INPUT_WEBHOOK_SECRET", "")
+SERVER_HOST = os.getenv("INPUT_SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("INPUT_SERVER_PORT", "8080"))
+# 同时 review 的 MR 数；每个 MR 内部仍按 INPUT_CONCURRENCY 并发调用 LLM，整体受共享限流器约束
+SERVER_WORKERS = max(1, int(os.getenv("INPUT_SERVER_WORKERS", "2")))
+# 排队中的 MR 数上限，队列满时 webhook 返回 503，由 GitLab 稍后重试
+SERVER_QUEUE_SIZE = int(os.getenv("INPUT_SERVER_QUEUE_SIZE", "100"))
+# 触发 review 的 MR 事件
+REVIEW_ACTIONS = {"open", "reopen", "update"}
+
+
+class ReviewQueue:
+    """
+    MR review 任务队列和 worker 线程池
+    同一个 MR 同时最多只有一个任务在排队（review 开始时才拉取最新的 head，重复的推送事件直接合并）；
+    正在 review 时又收到推送，则在当前 review 结束后再 review 一次。同一个 MR 不会被并发 review
+    """
+    def __init__(self, workers=SERVER_WORKERS, maxsize=SERVER_QUEUE_SIZE, cache=None):
+        self.cache = cache
+        self.completed = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._running = set()
+        self._rerun = set()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"review-worker-{i}", daemon=True) for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """ 处理完已排队的任务后停止所有 worker """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def submit(self, project_id, mr_iid):
+        """
+        提交一个 MR 的 review 任务，已在排队时返回 False；队列已满时抛出 queue.Full
+        """
+        key = (str(project_id), str(mr_iid))
+        with self._lock:
+            if key in self._pending:
+                return False
+            if key in self._running:
+                self._rerun.add(key)
+                return True
+            self._queue.put_nowait(key)
+            self._pending.add(key)
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "queued": len(self._pending),
+                "running": [f"{project_id}!{mr_iid}" for project_id, mr_iid in sorted(self._running)],
+                "completed": self.completed,
+                "failed": self.failed,
+            }
+
+    def _work(self):
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            with self._lock:
+                self._pending.discard(key)
+                self._running.add(key)
+            print(f"Reviewing merge request {key[1]} of project {key[0]}")
+            try:
+                main.review_merge_request(*key, cache=self.cache)
+                succeeded = True
+            except Exception as e:
+                print(f"Review of merge request {key[1]} of project {key[0]} failed:", e)
+                succeeded = False
+            with self._lock:
+                self._running.discard(key)
+                if succeeded:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                rerun = key in self._rerun
+                self._rerun.discard(key)
+            if rerun:
+                try:
+                    self.submit(*key)
+                except queue.Full:
+                    print(f"Review queue is full, dropping follow-up review of merge request {key[1]}")
+
+
+review_queue = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global review_queue
+    main.validate_config()
+    tracer_provider = main.setup_tracing()
+    if not WEBHOOK_SECRET:
+        print("INPUT_WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+    # main 中的 SDK 和客户端是按需创建的，服务启动时提前创建好，第一个 MR 也不用等待
+    for backend in main.get_llm_pool().backends:
+        backend.client
+    main.get_gitlab_client()
+    # 所有 worker 共享同一个 review 缓存（ReviewCache 内部加锁，可跨线程使用）
+    cache = main.open_review_cache()
+    review_queue = ReviewQueue(cache=cache)
+    review_queue.start()
+    try:
+        yield
+    finally:
+        review_queue.stop()
+        if cache:
+            cache.close()
+        main.write_run_report()
+        if tracer_provider:
+            tracer_provider.shutdown()
+
+
+app = FastAPI(title="AI code review", lifespan=lifespan)
+
+
+@app.post("/webhook", status_code=202)
+async def webhook(request: Request, x_gitlab_token: str = Header(default="")):
+    """
+    GitLab Merge Request webhook：MR 打开、重新打开或有新提交时把 review 任务放入队列，立即返回
+    """
+    if WEBHOOK_SECRET and not hmac.compare_digest(x_gitlab_token.encode(), WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=401, detail="invalid webhook token")
+    event = await request.json()
+    if event.get("object_kind") != "merge_request":
+        return {"queued": False, "reason": "not a merge request event"}
+    attributes = event.get("object_attributes") or {}
+    if attributes.get("state") != "opened" or attributes.get("action") not in REVIEW_ACTIONS:
+        return {"queued": False, "reason": "merge request is not opened or action is ignored"}
+    # update 事件只有推送了新提交时才带 oldrev，标题、描述、标签等修改不触发 review
+    if attributes.get("action") == "update" and not attributes.get("oldrev"):
+        return {"queued": False, "reason": "no new commits"}
+
+    project_id = (event.get("project") or {}).get("id") or attributes.get("target_project_id")
+    mr_iid = attributes.get("iid")
+    if not project_id or not mr_iid:
+        raise HTTPException(status_code=400, detail="missing project id or merge request iid")
+    try:
+        queued = review_queue.submit(project_id, mr_iid)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="review queue is full")
+    return {"queued": queued, "project_id": project_id, "merge_request_iid": mr_iid}
+
+
+@app.get("/healthz")
+def healthz():
+    return review_queue.snapshot()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    进程启动以来所有 MR review 的阶段耗时和计数器（OpenMetrics 文本格式），供 Prometheus 抓取
+    """
+    return PlainTextResponse(main.metrics.openmetrics(),
+                             media_type="application/openmetrics-text; version=1.0.0; charset=utf-8")
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
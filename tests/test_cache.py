@@ -0,0 +1,62 @@
+import main
+from main import DiffChange, DiffChunk, DiffFile
+
+LINES = ["def load(path):", "    return open(path).read()"]
+
+
+def make_file(start, path="app/io.py"):
+    """ 在新文件第 start 行新增 LINES 的 diff """
+    changes = [DiffChange(start + i, None, line) for i, line in enumerate(LINES)]
+    return DiffFile(path, [DiffChunk("def load", changes)])
+
+
+def fake_llm(monkeypatch, calls):
+    def review_with_cascade(items, pr_details, on_review, deadline=None, tier="large"):
+        calls.append(items)
+        _, chunk = items[0]
+        review = {"new_line": chunk.changes[1].ln, "old_line": 0, "reviewComment": "file is never closed"}
+        on_review(review)
+        return [review]
+    monkeypatch.setattr(main, "review_with_cascade", review_with_cascade)
+
+
+def test_key_does_not_depend_on_position(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "test-model")
+    first, moved = make_file(10), make_file(50)
+    assert main.ReviewCache.key(first, first.chunks[0]) == main.ReviewCache.key(moved, moved.chunks[0])
+    other = make_file(10, "app/other.py")
+    assert main.ReviewCache.key(first, first.chunks[0]) != main.ReviewCache.key(other, other.chunks[0])
+    assert main.ReviewCache.key(first, first.chunks[0]) != main.ReviewCache.key(first, first.chunks[0], "other")
+
+
+def test_moved_chunk_hits_cache_at_its_new_lines(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "test-model")
+    calls = []
+    fake_llm(monkeypatch, calls)
+    cache = main.ReviewCache(":memory:")
+    first, moved = make_file(10), make_file(50)
+
+    [comments] = main.review_chunks([(first, first.chunks[0])], {}, cache=cache)
+    assert [c["new_line"] for c in comments] == [11]
+
+    # 代码块整体下移（上方插入了代码）后命中缓存，不再调用 LLM，评论落在新位置
+    [comments] = main.review_chunks([(moved, moved.chunks[0])], {}, cache=cache)
+    assert len(calls) == 1
+    assert [c["new_line"] for c in comments] == [51]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_expired_entries_are_ignored():
+    cache = main.ReviewCache(":memory:", ttl=-1)
+    cache.set("key", [{"new_line": 1}])
+    assert cache.get("key") is None
+
+
+def test_evicts_least_recently_accessed():
+    cache = main.ReviewCache(":memory:", max_entries=2)
+    cache.set("a", [])
+    cache.set("b", [])
+    cache.get("a")
+    cache.set("c", [])
+    assert cache.get("b") is None
+    assert cache.get("a") == [] and cache.get("c") == []
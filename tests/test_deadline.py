@@ -0,0 +1,25 @@
+import main
+
+
+def deadline_with(remaining, seconds=600, reserve=30):
+    deadline = main.Deadline(seconds, reserve)
+    deadline.expires = main.time.monotonic() + remaining
+    return deadline
+
+
+def test_request_timeout_leaves_time_to_publish_summary():
+    # 在 can_start 变为 False 之前发起的请求，超时截止在预留时间的一半处
+    deadline = deadline_with(30.5)
+    assert deadline.can_start()
+    assert deadline.request_timeout() <= 30.5 - 15
+    assert deadline_with(300).request_timeout() <= 300 - 15
+
+
+def test_request_timeout_has_a_floor():
+    assert deadline_with(5).request_timeout() == 1.0
+
+
+def test_reserve_is_at_most_half_the_budget():
+    deadline = main.Deadline(20, reserve=30)
+    assert deadline.reserve == 10
+    assert deadline.request_timeout() <= 20 - 5
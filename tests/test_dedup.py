@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+import main
+from main import DiffChange, DiffChunk, DiffFile
+
+
+def make_item(path, start, lines):
+    chunk = DiffChunk("", [DiffChange(start + i, None, line) for i, line in enumerate(lines)])
+    return DiffFile(path, [chunk]), chunk
+
+
+A = ["value = compute()"]
+B = ["return value"]
+
+
+def fake_llm(monkeypatch, calls, error=None):
+    def review_with_cascade(items, pr_details, on_review, deadline=None, tier="large"):
+        calls.append(len(items))
+        if error:
+            raise error
+        reviews = []
+        for hunk_id, (_, chunk) in enumerate(items, 1):
+            review = {"hunk_id": hunk_id, "new_line": chunk.changes[0].ln, "reviewComment": chunk.changes[0].content}
+            on_review(review)
+            reviews.append(review)
+        return reviews
+    monkeypatch.setattr(main, "review_with_cascade", review_with_cascade)
+
+
+def run(target, *args):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault("value", target(*args)), daemon=True)
+    thread.start()
+    return thread, result
+
+
+def test_owner_resolves_its_chunks_before_waiting(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "test-model")
+    calls = []
+    fake_llm(monkeypatch, calls)
+    dedup = main.ReviewDeduper()
+    a, b = make_item("a.py", 10, A), make_item("b.py", 20, B)
+    # 另一个 MR 的线程已经 claim 了 B，并且它要等 A 的结果（反向的依赖）
+    b_key = main.ReviewCache.key(b[0], b[1])
+    owner, b_entry = dedup.claim(b_key)
+    assert owner
+
+    thread, result = run(main.review_chunks, [a, b], {}, None, None, None, dedup)
+    owner, a_entry = dedup.claim(main.ReviewCache.key(a[0], a[1]))
+    assert not owner
+    # 不会死锁：A 在本线程等待 B 之前就已 resolve
+    assert a_entry[0].wait(5)
+    assert thread.is_alive()
+
+    dedup.resolve(b_key, [{"new_line": 1, "reviewComment": "from other MR"}])
+    thread.join(5)
+    assert not thread.is_alive()
+    assert calls == [1]
+    assert [[c["new_line"] for c in comments] for comments in result["value"]] == [[10], [20]]
+
+
+def test_same_chunk_in_many_merge_requests_is_reviewed_once(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "test-model")
+    calls = []
+    fake_llm(monkeypatch, calls)
+    dedup = main.ReviewDeduper()
+    threads = [run(main.review_chunks, [make_item("a.py", start, A), make_item("b.py", start + 5, B)],
+                   {}, None, None, None, dedup) for start in (1, 30, 60, 90)]
+    for thread, _ in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert sum(calls) == 2
+    assert dedup.reused == 6
+    assert [[c["new_line"] for c in comments] for comments in threads[1][1]["value"]] == [[30], [35]]
+
+
+def test_failed_review_unblocks_waiters(monkeypatch):
+    monkeypatch.setattr(main, "OPENAI_API_MODEL", "test-model")
+    fake_llm(monkeypatch, [], error=RuntimeError("boom"))
+    dedup = main.ReviewDeduper()
+    a = make_item("a.py", 1, A)
+    with pytest.raises(RuntimeError):
+        main.review_chunks([a], {}, None, None, None, dedup)
+    # 失败的结果不复用：下一个 MR 重新负责 review
+    owner, _ = dedup.claim(main.ReviewCache.key(a[0], a[1]))
+    assert owner
@@ -0,0 +1,32 @@
+import main
+
+LONG = "x" * (main.MINIFIED_LINE_LENGTH + 1)
+
+
+def reason(path, diff=""):
+    return main.ExcludeMatcher().reason(path, diff)
+
+
+def test_bundle_with_one_long_line_is_minified():
+    diff = "@@ -1,2 +1,2 @@\n /*! lib v1.2 */\n-" + LONG + "\n+" + LONG + "\n"
+    assert reason("static/app.js", diff) == "minified"
+    assert reason("static/app.min.js") == "minified"
+
+
+def test_source_with_one_long_line_is_reviewed():
+    diff = "@@ -1,4 +1,5 @@\n import base64\n \n+ICON = '" + LONG + "'\n def icon():\n     return ICON\n"
+    assert reason("app/icons.py", diff) is None
+
+
+def test_source_with_mostly_long_lines_is_minified():
+    diff = "@@ -1,2 +1,2 @@\n-" + LONG + "\n+" + LONG + "\n"
+    assert reason("app/data.py", diff) == "minified"
+
+
+def test_lockfiles_binaries_and_generated_code():
+    assert reason("web/package-lock.json") == "lockfile"
+    assert reason("docs/logo.png") == "binary"
+    assert reason("api/service_pb2.py") == "generated"
+    assert reason("app/models.py", "@@ -0,0 +1,3 @@\n+# Code generated by sqlc. DO NOT EDIT.\n+x = 1\n+y = 2\n") \
+        == "generated"
+    assert reason("app/models.py", "@@ -0,0 +1,2 @@\n+x = 1\n+y = 2\n") is None
@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ("openai", "gitlab", "requests", "unidiff")
+
+
+def test_import_does_not_load_heavy_sdks():
+    # 在新进程中导入：其他测试可能已经在本进程中加载了这些 SDK
+    # 导入耗时的检查见 python3 main.py --import-time-budget
+    code = "import sys, main; print(' '.join(m for m in %r if m in sys.modules))" % (HEAVY_MODULES,)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
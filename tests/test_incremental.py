@@ -0,0 +1,69 @@
+import types
+
+import main
+
+# MR 的完整 diff：app.py 两个代码块，util.py 一个代码块；与 change_to_diff 一样文件头不带 a/ b/ 前缀
+MR_DIFF = """\
+--- app.py
++++ app.py
+@@ -1,3 +1,4 @@
+ import os
++import sys
+ 
+ def main():
+@@ -20,3 +21,4 @@ def main():
+     run()
++    cleanup()
+     return 0
+ 
+--- util.py
++++ util.py
+@@ -5,2 +5,3 @@
+ def helper():
++    pass
+     return None
+"""
+
+
+def make_session(compare_diffs, versions=("v1", "v2")):
+    mr = types.SimpleNamespace(diffs=types.SimpleNamespace(
+        list=lambda get_all=False: [types.SimpleNamespace(head_commit_sha=sha) for sha in versions]))
+    project = types.SimpleNamespace(repository_compare=lambda since, head: {"diffs": compare_diffs})
+    return types.SimpleNamespace(mr=mr, project=project)
+
+
+def compare_change(path, diff):
+    return {"old_path": path, "new_path": path, "diff": diff}
+
+
+def kept(touched):
+    return [(file.to, [chunk.changes[0].ln for chunk in file.chunks])
+            for file in main.filter_incremental(main.parse_diff(MR_DIFF), touched)]
+
+
+def test_only_hunks_touched_by_new_commits():
+    # v1 之后的新提交只加了 cleanup() 这一行
+    diff = "@@ -21,2 +21,3 @@ def main():\n     run()\n+    cleanup()\n     return 0\n"
+    session = make_session([compare_change("app.py", diff)])
+    touched = main.get_incremental_lines(session, "v1", "v2")
+    assert touched == {"app.py": {22}}
+    assert kept(touched) == [("app.py", [21])]
+
+
+def test_removed_line_marks_following_line():
+    diff = "@@ -5,3 +5,2 @@\n def helper():\n-    log()\n     return None\n"
+    session = make_session([compare_change("util.py", diff)])
+    touched = main.get_incremental_lines(session, "v1", "v2")
+    assert touched == {"util.py": {6}}
+    assert kept(touched) == [("util.py", [5])]
+
+
+def test_file_without_diff_is_reviewed_whole():
+    # compare 接口对过大的文件不返回 diff
+    touched = main.get_incremental_lines(make_session([compare_change("app.py", "")]), "v1", "v2")
+    assert touched == {"app.py": None}
+    assert kept(touched) == [("app.py", [1, 21])]
+
+
+def test_rewritten_history_falls_back():
+    assert main.get_incremental_lines(make_session([], versions=("v3",)), "v1", "v3") is None
@@ -0,0 +1,32 @@
+import main
+
+
+def test_percentile_nearest_rank():
+    samples = list(range(1, 21))
+    assert main.percentile(samples, 0.5) == 10
+    assert main.percentile(samples, 0.95) == 19
+    assert main.percentile([1, 2], 0.5) == 1
+    assert main.percentile(list(range(1, 101)), 0.07) == 7
+    assert main.percentile([5], 0.95) == 5
+
+
+def test_stage_stats_keeps_bounded_samples():
+    stats = main.StageStats()
+    for i in range(main.METRICS_RESERVOIR_SIZE * 3):
+        stats.add(i / 1000)
+    assert stats.count == main.METRICS_RESERVOIR_SIZE * 3
+    assert stats.max == (main.METRICS_RESERVOIR_SIZE * 3 - 1) / 1000
+    assert len(stats.samples) == main.METRICS_RESERVOIR_SIZE
+
+
+def test_report_percentiles_per_stage():
+    metrics = main.RunMetrics()
+    for ms in range(1, 21):
+        metrics.observe("llm_call", ms / 1000)
+    metrics.incr("comments_posted", 2)
+    metrics.incr("comments_failed", 0)
+    report = metrics.report()
+    assert report["stages"]["llm_call"]["count"] == 20
+    assert report["stages"]["llm_call"]["p50_ms"] == 10
+    assert report["stages"]["llm_call"]["p95_ms"] == 19
+    assert report["counters"] == {"comments_posted": 2}
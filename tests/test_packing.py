@@ -0,0 +1,55 @@
+import main
+from main import DiffChange, DiffChunk, DiffFile
+
+
+def make_item(path, lines):
+    chunk = DiffChunk("", [DiffChange(i + 1, None, line) for i, line in enumerate(lines)])
+    return DiffFile(path, [chunk]), chunk
+
+
+def size(item):
+    return main.count_tokens(main.format_chunk(item[1]))
+
+
+def test_pack_chunks_fits_budget_and_keeps_order():
+    sizes = [3, 8, 1, 5, 2, 7]
+    items = [make_item(f"f{i}.py", [f"x_{i}_{j} = {j}" for j in range(n)]) for i, n in enumerate(sizes)]
+    budget = size(items[1]) + size(items[2])
+    groups = main.pack_chunks(items, budget)
+
+    assert sorted(items.index(item) for group in groups for item in group) == list(range(len(items)))
+    for group in groups:
+        assert sum(size(item) for item in group) <= budget
+        assert group == sorted(group, key=items.index)
+    assert groups == sorted(groups, key=lambda group: items.index(group[0]))
+    assert len(groups) < len(items)
+
+
+def test_oversized_chunk_is_packed_alone():
+    items = [make_item("big.py", [f"x = {j}" for j in range(50)]), make_item("a.py", ["a = 1"]),
+             make_item("b.py", ["b = 1"])]
+    groups = main.pack_chunks(items, size(items[1]) * 3)
+    assert groups == [[items[0]], [items[1], items[2]]]
+
+
+def test_reviews_are_split_back_by_hunk_id(monkeypatch):
+    items = [make_item(f"f{i}.py", ["value = compute()", "return value"]) for i in range(3)]
+    calls = []
+
+    def review_with_cascade(packed, pr_details, on_review, deadline=None, tier="large"):
+        calls.append(packed)
+        reviews = [
+            {"hunk_id": 3, "new_line": 2, "reviewComment": "third"},
+            {"hunk_id": "1", "new_line": 1, "reviewComment": "first"},
+            {"hunk_id": 9, "new_line": 1, "reviewComment": "unknown hunk"},
+            {"new_line": 1, "reviewComment": "no hunk"},
+        ]
+        for review in reviews:
+            on_review(review)
+        return reviews
+    monkeypatch.setattr(main, "review_with_cascade", review_with_cascade)
+
+    results = main.review_chunks(items, {})
+    assert len(calls) == 1
+    assert [[(c["path"], c["new_line"], c["body"].split("\n")[0]) for c in comments] for comments in results] == [
+        [("f0.py", 1, "first")], [], [("f2.py", 2, "third")]]
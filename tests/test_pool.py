@@ -0,0 +1,36 @@
+import types
+
+import main
+
+
+class ServerError(Exception):
+    status_code = 503
+
+
+def fake_client(fail):
+    def create(**params):
+        if fail:
+            raise ServerError("503")
+        return "ok"
+    return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+
+
+def test_failing_backend_only_opens_its_own_breaker(monkeypatch):
+    bad = main.LLMBackend("test-bad", "http://bad", "m", "k", weight=100)
+    good = main.LLMBackend("test-good", "http://good", "m", "k", requests_per_min=60)
+    monkeypatch.setitem(main._clients, "openai:test-bad", fake_client(True))
+    monkeypatch.setitem(main._clients, "openai:test-good", fake_client(False))
+    pool = main.LLMPool([bad, good])
+
+    results = []
+    for _ in range(main.BREAKER_FAILURES + 5):
+        try:
+            results.append(pool.create("large", messages=[]))
+        except ServerError:
+            results.append("error")
+
+    assert results[-5:] == ["ok"] * 5
+    assert bad.limiter.breaker.opened_at is not None
+    assert good.limiter.breaker.opened_at is None
+    # 只有发往 good 的请求计入它的限流器
+    assert good.limiter.request_bucket.tokens < 60 - 4
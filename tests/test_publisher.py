@@ -0,0 +1,84 @@
+import types
+
+import main
+
+
+class FakeDiscussions:
+    """ 模拟 mr.discussions：create 的讨论在之后的 list 中可见 """
+    def __init__(self):
+        self.created = []
+
+    def list(self, get_all=False):
+        return [types.SimpleNamespace(attributes={"notes": [{"body": d["body"], "position": d.get("position")}]})
+                for d in self.created]
+
+    def create(self, data, **kwargs):
+        self.created.append(data)
+        return data
+
+
+class FakeNotes:
+    def __init__(self, discussions):
+        self.discussions = discussions
+
+    def create(self, data, **kwargs):
+        # GitLab 中普通评论也会出现在讨论列表里
+        self.discussions.created.append(data)
+        return data
+
+
+def make_pr_details():
+    discussions = FakeDiscussions()
+    mr = types.SimpleNamespace(discussions=discussions, notes=FakeNotes(discussions))
+    return {"session": types.SimpleNamespace(mr=mr), "base_sha": "b", "head_sha": "h", "start_sha": "s"}
+
+
+COMMENTS = [
+    {"path": "app.py", "body": "check for None", "new_line": 3, "old_line": 0, "action": "Add"},
+    {"path": "app.py", "body": "unused import", "new_line": 0, "old_line": 7, "action": "Delete"},
+    {"path": "lib.py", "body": "check for None", "new_line": 3, "old_line": 2, "action": "Modify"},
+]
+
+
+def test_rerun_makes_no_redundant_writes():
+    pr_details = make_pr_details()
+    discussions = pr_details["session"].mr.discussions
+    first = main.CommentPublisher(pr_details)
+    first.publish(COMMENTS)
+    first.publish_note("summary")
+    assert len(discussions.created) == 4
+
+    # 流水线重试：新的发布器从 MR 已有的讨论重建索引，不再写入
+    second = main.CommentPublisher(pr_details)
+    second.publish(COMMENTS)
+    second.publish_note("summary")
+    assert len(discussions.created) == 4
+    assert second.posted == 0
+    assert second.skipped == 4
+
+
+def test_duplicate_comment_in_one_run_is_posted_once():
+    pr_details = make_pr_details()
+    publisher = main.CommentPublisher(pr_details)
+    publisher.publish(COMMENTS[:1] + [dict(COMMENTS[0], body="check for None  ")])
+    assert len(pr_details["session"].mr.discussions.created) == 1
+    assert (publisher.posted, publisher.skipped) == (1, 1)
+
+
+def test_failed_write_can_be_retried():
+    pr_details = make_pr_details()
+    discussions = pr_details["session"].mr.discussions
+    create = discussions.create
+
+    def fail_once(data, **kwargs):
+        discussions.create = create
+        raise ValueError("boom")
+
+    discussions.create = fail_once
+    publisher = main.CommentPublisher(pr_details)
+    try:
+        publisher.publish(COMMENTS[:1])
+    except ValueError:
+        pass
+    publisher.publish(COMMENTS[:1])
+    assert len(discussions.created) == 1
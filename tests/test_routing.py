@@ -0,0 +1,26 @@
+import main
+from main import DiffChange, DiffChunk, DiffFile
+
+
+def make_chunk(removed=(), added=(), header=""):
+    # DiffChange(ln, ln2, ...)：ln 为新文件行号，ln2 为旧文件行号
+    changes = [DiffChange(None, i + 1, line) for i, line in enumerate(removed)]
+    changes += [DiffChange(i + 1, None, line) for i, line in enumerate(added)]
+    return DiffChunk(header, changes)
+
+
+def test_complexity_score_counts_added_python_code():
+    added = ["def handle(items):", "    for item in items:", "        if item:", "            return item"]
+    chunk = make_chunk(added=added)
+    # 4 行 * 1.0 + 分支 2 * 3 + 函数 1 * 5
+    assert main.complexity_score(DiffFile("app/handler.py", [chunk]), chunk) == 15
+
+
+def test_complexity_score_ignores_removed_branches():
+    chunk = make_chunk(removed=["if ready:", "    run()"], added=["x = 1", "y = 2"])
+    assert main.complexity_score(DiffFile("app/a.py", [chunk]), chunk) == 4
+
+
+def test_complexity_score_low_risk_path():
+    chunk = make_chunk(added=["x = 1", "y = 2"])
+    assert main.complexity_score(DiffFile("tests/test_a.py", [chunk]), chunk) == 2 * 0.3
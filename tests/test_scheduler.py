@@ -0,0 +1,55 @@
+import gitlab
+import requests
+
+import main
+
+
+def failing(error, times):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= times:
+            raise error
+        return "ok"
+    return fn, calls
+
+
+def test_write_is_not_retried_after_server_error():
+    scheduler = main.RateLimitScheduler("test", base_delay=0, breaker_failures=0)
+    fn, calls = failing(gitlab.exceptions.GitlabHttpError("bad gateway", 502), 1)
+    try:
+        scheduler.call(fn, idempotent=False)
+    except gitlab.exceptions.GitlabHttpError:
+        pass
+    assert len(calls) == 1
+
+    fn, calls = failing(requests.exceptions.ReadTimeout("timed out"), 1)
+    try:
+        scheduler.call(fn, idempotent=False)
+    except requests.exceptions.ReadTimeout:
+        pass
+    assert len(calls) == 1
+
+
+def test_write_is_retried_after_rate_limit():
+    scheduler = main.RateLimitScheduler("test", base_delay=0, breaker_failures=0)
+    fn, calls = failing(gitlab.exceptions.GitlabHttpError("too many requests", 429), 2)
+    assert scheduler.call(fn, idempotent=False) == "ok"
+    assert len(calls) == 3
+
+
+def test_read_is_retried_after_server_error():
+    scheduler = main.RateLimitScheduler("test", base_delay=0, breaker_failures=0)
+    fn, calls = failing(gitlab.exceptions.GitlabHttpError("bad gateway", 502), 1)
+    assert scheduler.call(fn) == "ok"
+    assert len(calls) == 2
+
+
+def test_retry_after_from_gitlab_response():
+    response = requests.models.Response()
+    response.status_code = 429
+    response.headers["Retry-After"] = "7"
+    main.traced_gitlab_request(lambda *args, **kwargs: response, "POST", "https://gitlab.example.com/api/v4/x")
+    assert main.retry_after_seconds(gitlab.exceptions.GitlabHttpError("too many requests", 429)) == 7
+    assert main.retry_after_seconds(gitlab.exceptions.GitlabHttpError("bad gateway", 502)) is None
@@ -0,0 +1,30 @@
+import main
+
+
+def test_stream_parser_across_fragments():
+    text = ('```json\n{"reviews": [{"hunk_id": 1, "new_line": 3, "old_line": 0, "reviewComment": "use {} here"}, '
+            '{"hunk_id": 2, "new_line": 5, "reviewComment": "ok",},]}\n```')
+    parser = main.ReviewStreamParser()
+    reviews = []
+    for i in range(0, len(text), 7):
+        reviews += parser.feed(text[i:i + 7])
+    assert parser.found
+    assert [r["reviewComment"] for r in reviews] == ["use {} here", "ok"]
+    assert reviews[0]["new_line"] == 3
+
+
+def test_stream_parser_drops_malformed_object_only():
+    parser = main.ReviewStreamParser()
+    reviews = parser.feed('{"reviews": [{"reviewComment": "bad" "x"}, {"reviewComment": "good"}]}')
+    assert [r["reviewComment"] for r in reviews] == ["good"]
+
+
+def test_stream_parser_without_json():
+    parser = main.ReviewStreamParser()
+    assert parser.feed("LGTM") == []
+    assert not parser.found
+
+
+def test_stream_parser_truncated_reply():
+    parser = main.ReviewStreamParser()
+    assert parser.feed('{"reviews": [{"reviewComment": "ok"}, {"reviewComment": "cut') == [{"reviewComment": "ok"}]
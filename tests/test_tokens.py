@@ -0,0 +1,51 @@
+import main
+from main import DiffChange, DiffChunk, DiffFile
+
+
+def added_chunk(lines, header=""):
+    return DiffChunk(header, [DiffChange(i + 1, None, line) for i, line in enumerate(lines)])
+
+
+def line_tokens(chunk):
+    return [main.count_tokens(c.content) + main.count_tokens(main.format_change(c)) for c in chunk.changes]
+
+
+def test_split_chunk_windows_overlap_and_fit_budget():
+    chunk = added_chunk([f"value_{i} = compute({i})" for i in range(20)], header="def f():")
+    tokens = line_tokens(chunk)
+    budget = max(tokens) * 5
+    windows = main.split_chunk(chunk, budget + main.count_tokens(chunk.header), overlap_lines=2)
+
+    assert len(windows) > 1
+    assert windows[0].changes[0] is chunk.changes[0]
+    assert windows[-1].changes[-1] is chunk.changes[-1]
+    for window in windows:
+        assert window.header == chunk.header
+        assert sum(tokens[chunk.changes.index(c)] for c in window.changes) <= budget
+    for previous, current in zip(windows, windows[1:]):
+        assert previous.changes[-2:] == current.changes[:2]
+
+
+def test_split_chunk_overlap_is_context_only():
+    chunk = added_chunk([f"value_{i} = compute({i})" for i in range(20)])
+    windows = main.split_chunk(chunk, max(line_tokens(chunk)) * 5, overlap_lines=2)
+    owned = [c for window in windows for c in window.owned_changes]
+    # 每一行恰好由一个窗口负责
+    assert owned == chunk.changes
+    assert all(window.owned_from == 2 for window in windows[1:])
+
+
+def test_split_chunk_keeps_oversized_line():
+    chunk = added_chunk(["x" * 400, "y = 1"])
+    windows = main.split_chunk(chunk, 5, overlap_lines=0)
+    assert [len(w.changes) for w in windows] == [1, 1]
+
+
+def test_overlap_line_is_commented_once():
+    chunk = added_chunk([f"value_{i} = compute({i})" for i in range(20)])
+    windows = main.split_chunk(chunk, max(line_tokens(chunk)) * 5, overlap_lines=2)
+    file = DiffFile("a.py", windows)
+    overlap_line = windows[1].changes[0].ln
+    review = {"new_line": overlap_line, "old_line": 0, "reviewComment": "check this"}
+    comments = [c for window in windows for c in main.create_comment(file, window, [review])]
+    assert [c["new_line"] for c in comments] == [overlap_line]
@@ -0,0 +1,82 @@
+import main
+from main import DiffChange, DiffChunk
+
+
+def make_chunk(*lines):
+    """ 按 unified diff 的前缀（"-" 删除、"+" 新增、" " 上下文）构造代码块 """
+    changes = []
+    old = new = 1
+    for line in lines:
+        prefix, content = line[0], line[1:]
+        if prefix == "-":
+            changes.append(DiffChange(None, old, content))
+            old += 1
+        elif prefix == "+":
+            changes.append(DiffChange(new, None, content))
+            new += 1
+        else:
+            changes.append(DiffChange(new, old, content))
+            old += 1
+            new += 1
+    return DiffChunk("", changes)
+
+
+def test_deletion():
+    assert main.classify_chunk("a.c", make_chunk("-int x = 1;")) == "deletion"
+
+
+def test_rewrapped_call_is_whitespace():
+    assert main.classify_chunk("a.c", make_chunk("-foo(a,", "-    b);", "+foo( a, b );")) == "whitespace"
+
+
+def test_string_literal_spaces_are_kept():
+    assert main.classify_chunk("a.js", make_chunk('-msg = "Hello world";', '+msg = "Helloworld";')) is None
+
+
+def test_token_boundaries_are_kept():
+    assert main.classify_chunk("a.c", make_chunk("-x = y - -z;", "+x = y --z;")) is None
+
+
+def test_python_comment_only_change():
+    assert main.classify_chunk("a.py", make_chunk("-x = 1  # old", "+x = 1  # new")) == "whitespace"
+
+
+def test_python_indentation_is_semantic():
+    assert main.classify_chunk("a.py", make_chunk("-    return x", "+return x")) is None
+
+
+def test_line_moved_across_context_is_not_whitespace():
+    assert main.classify_chunk("a.c", make_chunk("-free(p);", " use(p);", "+free(p);")) is None
+    assert main.classify_chunk("a.py", make_chunk("-x = compute()", " print(x)", "+x = compute()")) is None
+
+
+def test_reformat_around_context_is_whitespace():
+    assert main.classify_chunk("a.c", make_chunk("-int  a;", " use(a);", "-int  b;", "+int a;", "+int b;")) is None
+    assert main.classify_chunk("a.c", make_chunk("-int  a;", "+int a;", " use(a);", "-int  b;", "+int b;")) \
+        == "whitespace"
+
+
+def test_import_reorder():
+    assert main.classify_chunk("a.py", make_chunk("-import os", "-import sys", "+import sys", "+import os")) \
+        == "import_reorder"
+
+
+def test_real_change():
+    assert main.classify_chunk("a.py", make_chunk("-return a + b", "+return a - b")) is None
+
+
+def test_version_bump_in_manifests():
+    assert main.classify_chunk("requirements.txt", make_chunk("-requests==2.31.0", "+requests==2.32.3")) \
+        == "version_bump"
+    assert main.classify_chunk("package.json", make_chunk('-    "react": "^18.2.0",', '+    "react": "^18.3.1",')) \
+        == "version_bump"
+    assert main.classify_chunk("go.mod", make_chunk("-\tgithub.com/pkg/errors v0.9.1", "+\tgithub.com/pkg/errors v0.9.2")) \
+        == "version_bump"
+    assert main.classify_chunk("pyproject.toml", make_chunk('-version = "1.2.0"', '+version = "1.3.0"')) \
+        == "version_bump"
+    assert main.classify_chunk("VERSION", make_chunk("-1.2.0", "+1.2.1")) == "version_bump"
+
+
+def test_numeric_code_change_is_not_version_bump():
+    assert main.classify_chunk("a.py", make_chunk("-if version < 1.2:", "+if version < 3.4:")) is None
+    assert main.classify_chunk("setup.py", make_chunk("-    timeout=1.5,", "+    timeout=150.0,")) is None